@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Time each stage of the pipeline on synthetic profiles (see
+fapp_synth.py) and print the timings as JSON."""
+
+import argparse
+import importlib.util
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fapp_loader
+import fapp_synth
+
+REPO = Path(__file__).resolve().parent
+TRANSPILER_FILES = ["xls_parse.py", "xls_optimize.py", "fapp_loader.py"]
+
+
+def timed(func, *args, **kwargs):
+    begin = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - begin, result
+
+
+def summary(seconds, **extra):
+    return {
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "max": max(seconds),
+        "runs": seconds,
+        **extra,
+    }
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("xls_parse_out", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_revision():
+    cmd = ["git", "-C", str(REPO), "rev-parse", "--short", "HEAD"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def command(cmd, cwd, stdin=None):
+    def run():
+        subprocess.run(cmd, cwd=cwd, check=True, stdin=stdin, stdout=subprocess.DEVNULL)
+
+    return run
+
+
+def bench_transpile(xlsx, workdir, repeat):
+    """Transpile in a copy of the repository, so the generated program
+    of the checkout isn't overwritten: from scratch (--rebuild), and
+    again reusing the record of the unchanged cells."""
+    for file in TRANSPILER_FILES + [f.name for f in REPO.glob("fapp_*.py.in")]:
+        shutil.copy(REPO / file, workdir)
+    cmd = [sys.executable, "xls_parse.py", str(Path(xlsx).expanduser().resolve())]
+    run = command(cmd + ["--rebuild"], workdir)
+    full = [timed(run)[0] for _ in range(repeat)]
+    run = command(cmd, workdir)
+    incremental = [timed(run)[0] for _ in range(repeat)]
+    results = {
+        "transpile": summary(full),
+        "transpile_incremental": summary(incremental),
+    }
+    return results, workdir / "xls_parse_out.py"
+
+
+def bench_program(module, profile, roi, cmg, repeat, lookups):
+    results = {}
+    seconds, fapp_xml = [], None
+    for _ in range(repeat):
+        t, fapp_xml = timed(module.FappXml, profile, roi, cmg)
+        seconds.append(t)
+    results["load"] = summary(seconds)
+
+    pairs = [(e, t) for e in fapp_xml.event_rows for t in range(len(fapp_xml.cmg_tids))]
+    pairs = (pairs * (lookups // max(len(pairs), 1) + 1))[:lookups]
+
+    def lookup():
+        for event_name, thread_id in pairs:
+            fapp_xml.get_event(event_name, thread_id)
+
+    seconds = [timed(lookup)[0] for _ in range(repeat)]
+    results["get_event"] = summary(seconds, lookups=len(pairs))
+
+    if hasattr(module, "compute"):
+        seconds = [timed(module.compute, fapp_xml)[0] for _ in range(repeat)]
+        results["evaluate"] = summary(seconds)
+    return results
+
+
+def bench_flatten(program, profiles, workdir, jobs, repeat):
+    listing = workdir / "profiles.txt"
+    listing.write_text("".join(f"{p}\n" for p in profiles))
+    cmd = [sys.executable, str(REPO / "flatten.py"), "--infile", str(listing)]
+    cmd += ["--parser", str(program), "--jobs", str(jobs)]
+    run = command(cmd, workdir)
+    seconds = [timed(run)[0] for _ in range(repeat)]
+    return summary(seconds, directories=len(profiles), jobs=jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--xlsx",
+        help="Workbook to time the transpilation with (its program is then "
+        "used for the other stages)",
+    )
+    parser.add_argument(
+        "--program",
+        help="Generated module (xls_parse_out.py) to time, if no --xlsx is given",
+    )
+    parser.add_argument(
+        "--profiles",
+        help="Number of synthetic profile directories (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--regions",
+        help="Comma separated region names (default: all,kernel)",
+        default="all,kernel",
+    )
+    parser.add_argument("--procs", help="Processes (default: 1)", type=int, default=1)
+    parser.add_argument(
+        "--threads", help="Threads per CMG (default: 12)", type=int, default=12
+    )
+    parser.add_argument("--cmgs", help="CMGs (default: 4)", type=int, default=4)
+    parser.add_argument(
+        "--events",
+        help="Number of events if there is no program to take them from "
+        "(default: 306)",
+        type=int,
+        default=306,
+    )
+    parser.add_argument("--roi", help="Region (default: kernel)", default="kernel")
+    parser.add_argument(
+        "--repeat", help="Runs of each stage (default: 3)", type=int, default=3
+    )
+    parser.add_argument(
+        "--lookups",
+        help="get_event calls per run (default: 100000)",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--jobs", help="flatten.py --jobs (default: 1)", type=int, default=1
+    )
+    parser.add_argument(
+        "--output",
+        help="Append the results as one JSON line to this file (default: stdout)",
+    )
+    args = parser.parse_args()
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "stages": {},
+    }
+    stages = report["stages"]
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        program = args.program and Path(args.program).expanduser().resolve()
+        if args.xlsx:
+            results, program = bench_transpile(args.xlsx, workdir, args.repeat)
+            stages.update(results)
+
+        if program:
+            events = fapp_synth.program_events(program)
+        else:
+            events = [f"0x{idx:04x}" for idx in range(args.events)]
+        profiles = [workdir / f"profile{idx}" for idx in range(args.profiles)]
+        shape = {
+            "regions": args.regions.split(","),
+            "procs": args.procs,
+            "threads": args.threads,
+            "cmgs": args.cmgs,
+        }
+        seconds = []
+        for seed, profile in enumerate(profiles):
+            t, _ = timed(fapp_synth.write_profile, profile, events, seed, **shape)
+            seconds.append(t)
+        stages["generate"] = summary(seconds, events=len(events))
+
+        # Without a program only the loader is timed.
+        module = load_module(program) if program else fapp_loader
+        stages.update(
+            bench_program(module, profiles[0], args.roi, 0, args.repeat, args.lookups)
+        )
+
+        if program:
+            stages["flatten"] = bench_flatten(
+                program, profiles, workdir, args.jobs, args.repeat
+            )
+
+    line = json.dumps(report, default=str)
+    if args.output is None:
+        print(line)
+    else:
+        with open(Path(args.output).expanduser(), "a") as output:
+            output.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,96 +1,878 @@
 #! /usr/bin/env python
+import csv
+import gzip
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+import sys
+import tarfile
+import time
 import xml.etree.ElementTree as ET
-from collections import defaultdict
+import zipfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 
+# Marks an (event, thread) cell of the counter matrix without a value.
+MISSING_COUNTER = -1
+# The empty cell of `get_float_event`.
+NAN = float("nan")
+
+
+ENV_PROCESS = ("environment", "spawn", "process")
+REGION_THREAD = ("information", "region", "spawn", "process", "thread")
+
+# paN.xml (or paN.csv), optionally compressed, anywhere in a directory or
+# an archive.
+PA_FILE = re.compile(r"(?:^|/)pa(\d+)\.(xml|csv)(?:\.gz|\.xz|\.zst)?$")
+
+# Binary pack of a profile (see `write_pack`): the magic, the version and
+# the length of a JSON header with the environment and the tables of the
+# regions, followed by their (row major event x thread) int64 counters.
+PACK_MAGIC = b"FAPPPACK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<8sII")
+PACK_SUFFIX = ".fpk"
+
+# First cells of the rows of paN.csv files read by `read_pa_csv`.
+CSV_ENVIRONMENT = {
+    "Measured time": "measured_time",
+    "Vector length": "vector_length",
+    "Timer frequency": "counter_timer_freq",
+}
+CSV_THREADS = ["Process", "Node", "Thread", "CMG"]
+CSV_COUNTERS = ["Region", "Region id", "Process", "Thread"]
+
+
+def new_region(measured_region):
+    return {"measured_region": measured_region, "cpupa_tids": set(), "events": {}}
+
+
+def add_cpupa(region, key, elem, stack):
+    """Add a closed cpupa element (of REGION_THREAD) of a paN.xml."""
+    if len(key) == 7 and key[5:] == ("cpupa", "event"):
+        tid = stack[-2].get("id")
+        # The first thread with a given id wins (same as `find`).
+        events = region["events"].setdefault(elem.get("name"), {})
+        events.setdefault(tid, int(elem.text))
+    elif len(key) == 6 and key[5] == "cpupa":
+        region["cpupa_tids"].add(stack[-1].get("id"))
+
+
+def add_environment(environment, key, elem, stack):
+    """Add a closed element (of ENV_PROCESS) of a paN.xml."""
+    if key == ENV_PROCESS:
+        environment["process_no"] = int(elem.get("id"))
+    elif key[3:] == ("host",):
+        environment["node_name"] = elem.get("name")
+    elif key[3:] == ("cntfrq",):
+        environment["counter_timer_freq"] = int(elem.text)
+    elif key[3:] == ("thread", "cmg"):
+        tid = stack[-1].get("id")
+        environment["threads"].append((tid, int(elem.get("id"))))
+
+
+def read_pa_xml(file, region_name=None, processes=False):
+    """Extract the environment and the counters of one region (of every
+    region if `region_name` is None) from a paN.xml file.
+
+    The file is streamed: every element is dropped as soon as it is
+    closed, so memory depends on the selected regions and not on the
+    size of the file.  Parsing stops once the region and the
+    environment have been seen.
+
+    The environment is the one of the first process, and the threads
+    of the other processes only add the events (or thread ids) the
+    first one doesn't have.  With `processes`, "processes" has the
+    environment and regions of each process (MPI rank) on its own,
+    keyed by process id.
+
+    """
+    environment = {"threads": []}
+    env_done = False
+    regions = {}
+    region = None  # the region being read
+    per_process = {}
+
+    def process(pid):
+        return per_process.setdefault(
+            pid, {"environment": {"threads": []}, "regions": {}}
+        )
+
+    path = []  # tags of the open elements (without the root)
+    stack = []  # the open elements
+    for kind, elem in ET.iterparse(file, events=("start", "end")):
+        if kind == "start":
+            if stack:
+                path.append(elem.tag)
+            stack.append(elem)
+            if len(path) == 2 and path[0] == "information" and elem.tag == "region":
+                name = elem.get("name")
+                if name not in regions and region_name in (None, name):
+                    region = regions[name] = new_region([name, int(elem.get("id"))])
+            continue
+
+        stack.pop()
+        key = tuple(path)
+        if region is not None and key[:5] == REGION_THREAD:
+            add_cpupa(region, key, elem, stack)
+            if processes and len(key) > 5:
+                name = region["measured_region"][0]
+                proc_regions = process(stack[4].get("id"))["regions"]
+                if name not in proc_regions:
+                    proc_regions[name] = new_region(region["measured_region"])
+                add_cpupa(proc_regions[name], key, elem, stack)
+        elif key[:3] == ENV_PROCESS:
+            if not env_done:
+                add_environment(environment, key, elem, stack)
+                env_done = key == ENV_PROCESS
+            if processes:
+                pid = elem.get("id") if key == ENV_PROCESS else stack[3].get("id")
+                add_environment(process(pid)["environment"], key, elem, stack)
+        elif key == ("environment", "measured_time"):
+            environment["measured_time"] = elem.text
+        elif key == ("environment", "vector_length"):
+            environment["vector_length"] = int(elem.get("vlen"))
+        elif key == ("information", "region"):
+            region = None
+
+        elem.clear()
+        if stack:
+            del stack[-1][-1]
+            path.pop()
+        if env_done and region is None and region_name in regions:
+            break
+
+    result = {"environment": environment, "regions": regions}
+    if processes:
+        for proc in per_process.values():
+            for name in ["measured_time", "vector_length"]:
+                if name in environment:
+                    proc["environment"][name] = environment[name]
+        result["processes"] = per_process
+    return result
+
+
+# Functions called with the stats of every `Profiler.report` (e.g. by
+# batch drivers running `main` in-process).
+PROFILE_HOOKS = []
+
+
+class Profiler:
+    """Wall time of the stages of a run and of the report sections of
+    `compute`, bytes of the paN.xml files read and numbers of calls.
+
+    A disabled profiler does nothing; `FappXml` and `compute` use one
+    unless given a profiler.
+
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stats = OrderedDict(
+            (k, OrderedDict()) for k in ["stages", "sections", "bytes", "calls"]
+        )
+        self.current_section = None
+
+    @contextmanager
+    def stage(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                stages = self.stats["stages"]
+                stages[name] = stages.get(name, 0) + time.perf_counter() - begin
+
+    def section(self, name):
+        """End the current section of `compute` and begin `name` (or none)."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.current_section is not None:
+            prev, begin = self.current_section
+            sections = self.stats["sections"]
+            sections[prev] = sections.get(prev, 0) + now - begin
+        self.current_section = None if name is None else (name, now)
+
+    def add_bytes(self, name, size):
+        if self.enabled:
+            self.stats["bytes"][name] = size
+
+    def add_stats(self, stats):
+        """Add the section times and numbers of calls of the `stats` of
+        another profiler (e.g. in a worker process)."""
+        if self.enabled:
+            for kind in ["sections", "calls"]:
+                totals = self.stats[kind]
+                for name, value in stats[kind].items():
+                    totals[name] = totals.get(name, 0) + value
+
+    def count_calls(self, obj, name):
+        """Count the calls of the method `name` of `obj` from now on."""
+        if not self.enabled:
+            return
+        method = getattr(obj, name)
+        calls = self.stats["calls"]
+        calls.setdefault(name, 0)
+
+        def counted(*args):
+            calls[name] += 1
+            return method(*args)
+
+        setattr(obj, name, counted)
+
+    def report(self):
+        for hook in PROFILE_HOOKS:
+            hook(self.stats)
+
+
+NULL_PROFILER = Profiler(enabled=False)
+
+
+def print_stats(stats):
+    """Profile hook of --profile."""
+    print(json.dumps(stats), file=sys.stderr)
+
+
+def decompressed(file, name):
+    """Binary stream of the file object `file` (named `name`),
+    decompressed on the fly if it is a .gz, .xz or .zst file."""
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=file)
+    if name.endswith(".xz"):
+        return lzma.LZMAFile(file)
+    if name.endswith(".zst"):
+        import zstandard  # optional, only needed for .zst files
+
+        return zstandard.ZstdDecompressor().stream_reader(file)
+    return file
+
+
+def profile_files(path):
+    """(name, size) of the paN.xml files of a profile, which is either a
+    directory or a .zip archive (see `read_tar` for .tar archives)."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+        return [
+            (i.filename, i.compress_size) for i in infos if PA_FILE.search(i.filename)
+        ]
+    files = [f for f in path.iterdir() if PA_FILE.search(f.name)]
+    return [(f.name, f.stat().st_size) for f in files]
+
+
+def profile_format(path, format=None):
+    """The format of the paN files `FappXml` reads from the profile `path`
+    (or "pack" for a pack file)."""
+    if is_pack(Path(path).expanduser()):
+        return "pack"
+    return format or "xml"
+
+
+def read_pa_file(path, name, region_name=None, processes=False):
+    """`read_pa_xml` of the file `name` of the profile `path`."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive, archive.open(name) as file:
+            with decompressed(file, name) as stream:
+                return read_pa(stream, name, region_name, processes)
+    with open(path / name, "rb") as file, decompressed(file, name) as stream:
+        return read_pa(stream, name, region_name, processes)
+
+
+def read_tar(path, files, region_name=None, format=None, processes=False):
+    """Yield the name, size and `read_pa` of the paN.xml (or, with
+    format="csv", paN.csv) files numbered in `files` of a (compressed)
+    tar archive, in one pass."""
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            match = PA_FILE.search(member.name)
+            if not (member.isfile() and match and int(match.group(1)) in files):
+                continue
+            if match.group(2) == (format or "xml"):
+                file = archive.extractfile(member)
+                with decompressed(file, member.name) as stream:
+                    yield member.name, member.size, read_pa(
+                        stream, member.name, region_name, processes
+                    )
+
+
+def needed_files(events, event_files):
+    """The numbers N of the paN.xml files with the `events`, or None (i.e.
+    every file) if the file of some event isn't in `event_files`."""
+    events = set(events) - {"LABEL-FAPP-cpupa"}
+    if not events <= event_files.keys():
+        return None
+    # pa1.xml has the environment and the labels.
+    return {1} | {event_files[name] for name in events}
+
+
+def read_pa_csv(file, region_name=None, processes=False):
+    """`read_pa_xml` of a paN.csv file (a binary stream or a path).
+
+    The file is expected to have (in any order, separated by other rows)
+    "Measured time", "Vector length" and "Timer frequency" rows with the
+    value in the second column, a table of the threads under a
+    "Process,Node,Thread,CMG" header, and a table of the counters under a
+    "Region,Region id,Process,Thread,<event>,<event>..." header, with one
+    row per region, process and thread and empty cells for missing
+    counters.  Only the first process is kept at the top level, and
+    every process in "processes" with `processes`, like in `read_pa_xml`.
+
+    This is the layout written by fapp_synth.py, not (as far as known)
+    the one of `fapp -tcsv`; other files raise a ValueError.
+
+    """
+    if isinstance(file, (str, Path)):
+        with open(file, "rb") as stream:
+            return read_pa_csv(stream, region_name, processes)
+    environment = {"threads": []}
+    regions = {}
+    per_process = {}
+    table = None  # header of the current table
+    tables = set()
+    # (Streams of tar members can't be wrapped by io.TextIOWrapper.)
+    for row in csv.reader(line.decode("utf-8") for line in file):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            table = None
+        elif row[0] in CSV_ENVIRONMENT and len(row) > 1:
+            environment[CSV_ENVIRONMENT[row[0]]] = row[1]
+        elif row[: len(CSV_THREADS)] == CSV_THREADS or row[:4] == CSV_COUNTERS:
+            table = row
+            tables.add(row[0])
+        elif table and table[0] == "Process":
+            proc, node, tid, cmg = row[:4]
+            environment.setdefault("process_no", int(proc))
+            environment.setdefault("node_name", node)
+            if int(proc) == environment["process_no"]:
+                environment["threads"].append((tid, int(cmg)))
+            if processes:
+                env = per_process.setdefault(
+                    proc, {"environment": {"threads": []}, "regions": {}}
+                )["environment"]
+                env.update(process_no=int(proc), node_name=node)
+                env["threads"].append((tid, int(cmg)))
+        elif table and table[0] == "Region":
+            name, region_id, proc, tid = row[:4]
+            if region_name not in (None, name):
+                continue
+            region = regions.setdefault(
+                name,
+                {
+                    "measured_region": [name, int(region_id)],
+                    "cpupa_tids": set(),
+                    "events": {},
+                    "process_no": proc,
+                },
+            )
+            targets = [region] if proc == region["process_no"] else []
+            if processes:
+                proc_regions = per_process.setdefault(
+                    proc, {"environment": {"threads": []}, "regions": {}}
+                )["regions"]
+                if name not in proc_regions:
+                    proc_regions[name] = new_region(region["measured_region"])
+                targets.append(proc_regions[name])
+            for target in targets:
+                target["cpupa_tids"].add(tid)
+                for event_name, value in zip(table[4:], row[4:]):
+                    if value != "":
+                        events = target["events"].setdefault(event_name, {})
+                        events.setdefault(tid, int(value))
+    missing = [k for k in CSV_ENVIRONMENT if CSV_ENVIRONMENT[k] not in environment]
+    missing += [",".join(t) for t in [CSV_THREADS, CSV_COUNTERS] if t[0] not in tables]
+    if missing:
+        rows = ", ".join(f'"{m}"' for m in missing)
+        raise ValueError(
+            f"Unrecognized paN.csv layout (see read_pa_csv): no {rows} row"
+        )
+    for region in regions.values():
+        del region["process_no"]
+    for key in ["counter_timer_freq", "vector_length"]:
+        if key in environment:
+            environment[key] = int(environment[key])
+    result = {"environment": environment, "regions": regions}
+    if processes:
+        for proc in per_process.values():
+            for key in ["measured_time", "vector_length", "counter_timer_freq"]:
+                if key in environment:
+                    proc["environment"][key] = environment[key]
+        result["processes"] = per_process
+    return result
+
+
+def read_pa(file, name, region_name=None, processes=False):
+    """`read_pa_xml` or `read_pa_csv` of a stream, depending on `name`."""
+    if PA_FILE.search(name).group(2) == "csv":
+        return read_pa_csv(file, region_name, processes)
+    return read_pa_xml(file, region_name, processes)
+
+
+def pack_regions(regions, chunks, offset):
+    """The tables of the `regions` of a FappXml for the header of a pack,
+    with their counters appended to `chunks` from the byte `offset` on."""
+    tables = {}
+    for name, region in regions.items():
+        counters = region["counters"]
+        tables[name] = {
+            "events": list(region["event_rows"]),
+            "threads": list(region["thread_cols"]),
+            "measured_region": region["measured_region"],
+            "cpupa_tids": sorted(region["cpupa_tids"]),
+            "offset": offset,
+            "length": len(counters),
+        }
+        chunks.append(counters)
+        offset += 8 * len(counters)
+    return tables, offset
+
+
+def write_pack(fapp_xml, path):
+    """Write the environment, the regions and the processes of `fapp_xml`
+    (read with region_name=None and processes=True) into a pack file."""
+    chunks = []
+    regions, offset = pack_regions(fapp_xml.regions, chunks, 0)
+    processes = OrderedDict()
+    for pid, process in fapp_xml.processes.items():
+        tables, offset = pack_regions(process["regions"], chunks, offset)
+        processes[pid] = {"environment": process["environment"], "regions": tables}
+    header = {
+        "environment": fapp_xml.environment,
+        "regions": regions,
+        "processes": processes,
+    }
+    header = json.dumps(header).encode()
+    # The counters start at a multiple of 8 bytes.
+    header += b" " * (-(PACK_HEADER.size + len(header)) % 8)
+    path = Path(path).expanduser()
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as file:
+        file.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(header)))
+        file.write(header)
+        for counters in chunks:
+            if sys.byteorder != "little":
+                counters = array("q", counters)
+                counters.byteswap()
+            file.write(counters)
+    os.replace(tmp, path)
+
+
+def is_pack(path):
+    if not path.is_file():
+        return False
+    with open(path, "rb") as file:
+        return file.read(len(PACK_MAGIC)) == PACK_MAGIC
+
+
+def read_pack(path):
+    """The environment, regions and processes (as in FappXml) of a pack
+    file.  The file is memory mapped and the counters are views of it, so
+    only the parsed header and the pages which are read take memory."""
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, length = PACK_HEADER.unpack_from(data)
+    assert (magic, version) == (PACK_MAGIC, PACK_VERSION), f"Unknown pack {path}"
+    start = PACK_HEADER.size + length
+    header = json.loads(data[PACK_HEADER.size : start])
+    view = memoryview(data)
+
+    def regions(tables):
+        result = {}
+        for name, table in tables.items():
+            begin = start + table["offset"]
+            counters = view[begin : begin + 8 * table["length"]].cast("q")
+            if sys.byteorder != "little":
+                counters = array("q", counters)  # a copy
+                counters.byteswap()
+            result[name] = {
+                "event_rows": {e: row for row, e in enumerate(table["events"])},
+                "thread_cols": {t: col for col, t in enumerate(table["threads"])},
+                "counters": counters,
+                "measured_region": table["measured_region"],
+                "cpupa_tids": set(table["cpupa_tids"]),
+            }
+        return result
+
+    processes = OrderedDict()
+    for pid, process in header["processes"].items():
+        processes[pid] = {
+            "environment": process["environment"],
+            "regions": regions(process["regions"]),
+        }
+    return header["environment"], regions(header["regions"]), processes
+
+
+class NotInProfile(AssertionError):
+    """The selected region or CMG isn't in the profile."""
+
+
+def pool_map(func, items, jobs=1):
+    """Like `map`, but with `jobs` worker processes (0: one per core)."""
+    jobs = min(jobs or os.cpu_count(), len(items))
+    if jobs <= 1:
+        return list(map(func, items))
+    with ProcessPoolExecutor(jobs) as pool:
+        return list(pool.map(func, items))
+
 
 class FappXml:
-    def __init__(self, path, region_name="kernel", cmg=0):
-        self.region_name = region_name
-        self.cmg = cmg
-        self.fill_xmls(path)
-        self.fill_event_dict()
-        self.fill_cmg_tids()
+    pack = None  # the path of the pack file the counters are mapped from
+    pack_pid = None  # the process of the pack (see `process`)
 
-    def fill_xmls(self, path):
-        pa_dir = Path(path).expanduser()
-        filenames = list(pa_dir.glob("pa*.xml"))  # need list here
-        self.xmls = [None for _ in filenames]
-        for file in filenames:
-            idx = int(file.name[2:-4]) - 1
-            self.xmls[idx] = ET.parse(file)
-        assert len(self.xmls) == 17, "Didn't find all 17 paN.xml files"
+    def __init__(
+        self,
+        path,
+        region_name="kernel",
+        cmg=0,
+        jobs=1,
+        profiler=None,
+        files=None,
+        format=None,
+        processes=False,
+    ):
+        # With region_name=None every region is loaded (see `select`), with
+        # `files` only these paN.xml files (see `needed_files`), with
+        # format="csv" the paN.csv files (see `read_pa_csv`, default: paN.xml)
+        # and with `processes` every process too (see `process`).  A pack
+        # file (see `write_pack`) has every region and process.
+        self.jobs = jobs
+        self.profiler = profiler or NULL_PROFILER
+        path = Path(path).expanduser()
+        if is_pack(path):
+            with self.profiler.stage("read_pack"):
+                self.environment, self.regions, self.processes = read_pack(path)
+            self.pack = path
+        else:
+            with self.profiler.stage("read_xml"):
+                self.fill_xmls(path, region_name, files, format, processes)
+            with self.profiler.stage("counters"):
+                self.fill_event_dict()
+            # Everything needed is in the counter matrices now.
+            del self.xmls
+        self.select(region_name, cmg)
+
+    def __getstate__(self):
+        if self.pack is None:
+            return self.__dict__
+        # The counters are views of the mapped pack, which is mapped again.
+        names = ["pack", "pack_pid", "region_name", "cmg"]
+        return {name: getattr(self, name) for name in names}
+
+    def __setstate__(self, state):
+        if state.get("pack") is None:
+            self.__dict__.update(state)
+            return
+        fapp_xml = FappXml(state["pack"], None, None)
+        if state["pack_pid"] is not None:
+            fapp_xml = fapp_xml.process(state["pack_pid"])
+        self.__dict__.update(fapp_xml.__dict__)
+        self.select(state["region_name"], state["cmg"])
+
+    def fill_xmls(self, path, region_name, files=None, format=None, processes=False):
+        # A directory or a .zip or .tar(.gz|.xz) archive of paN.xml files,
+        # which may be compressed too.  Nothing is extracted to disk.
+        path = Path(path).expanduser()
+        files = range(1, 18) if files is None else files
+        self.xmls = [None for _ in range(17)]
+        if path.is_file() and not zipfile.is_zipfile(path):
+            # Members of a compressed tar can only be read in order.
+            xmls = read_tar(path, files, region_name, format, processes)
+        else:
+            names = []
+            for name, size in profile_files(path):
+                match = PA_FILE.search(name)
+                if int(match.group(1)) in files:
+                    names.append((name, size, match.group(2)))
+            format = format or "xml"
+            names = [(name, size) for name, size, fmt in names if fmt == format]
+            # Only the extracted counters travel back from the workers.
+            read = partial(
+                read_pa_file, path, region_name=region_name, processes=processes
+            )
+            xmls = pool_map(read, [name for name, _ in names], self.jobs)
+            xmls = [(name, size, xml) for (name, size), xml in zip(names, xmls)]
+        for name, size, xml in xmls:
+            idx = int(PA_FILE.search(name).group(1)) - 1
+            if self.xmls[idx] is None:
+                self.xmls[idx] = xml
+            self.profiler.add_bytes(name, size)
+        missing = [
+            f"pa{idx}.{format or 'xml'}" for idx in files if not self.xmls[idx - 1]
+        ]
+        assert not missing, f"Didn't find {', '.join(missing)}"
+        self.environment = self.xmls[0]["environment"]
 
     def fill_event_dict(self):
-        self.event_dict = defaultdict(list)
-        query = f"./information/region[@name='{self.region_name}']"
-        query += "/spawn/process/thread/cpupa/event"
-        for idx, xml in enumerate(self.xmls):
-            for event in xml.getroot().findall(query):
-                event_name = event.get("name")
-                self.event_dict[event_name].append(idx)
-        assert self.event_dict, (
-            "No events found in the given region! "
-            "Is the correct --roi specified? (see --help)"
-        )
+        self.regions = self.regions_counters(self.xmls)
+        # The counters of each process (MPI rank), if they were read.
+        self.processes = OrderedDict()
+        for pid, process in self.xmls[0].get("processes", {}).items():
+            empty = {"regions": {}}
+            xmls = [xml and xml["processes"].get(pid, empty) for xml in self.xmls]
+            self.processes[pid] = {
+                "environment": process["environment"],
+                "regions": self.regions_counters(xmls),
+            }
+
+    def regions_counters(self, xmls):
+        regions = {}
+        for xml in filter(None, xmls):
+            for region_name in xml["regions"]:
+                if region_name not in regions:
+                    regions[region_name] = self.region_counters(region_name, xmls)
+        # Regions without cpupa events can't be evaluated.
+        return {k: v for k, v in regions.items() if v["event_rows"]}
+
+    def region_counters(self, region_name, xmls):
+        # Each event is taken from the first paN.xml which has it.
+        sources = {}
+        for xml in filter(None, xmls):
+            region = xml["regions"].get(region_name, {"events": {}})
+            for event_name, values in region["events"].items():
+                sources.setdefault(event_name, values)
+
+        thread_cols = {}
+        for values in sources.values():
+            for tid in values:
+                thread_cols.setdefault(tid, len(thread_cols))
+
+        # Row major event x thread matrix.
+        width = len(thread_cols)
+        counters = array("q", [MISSING_COUNTER]) * (len(sources) * width)
+        for row, values in enumerate(sources.values()):
+            for tid, value in values.items():
+                counters[row * width + thread_cols[tid]] = value
+
+        # The labels are read from pa1.xml (like Excel does).
+        pa1_region = xmls[0]["regions"].get(region_name, {})
+        return {
+            "event_rows": {name: row for row, name in enumerate(sources)},
+            "thread_cols": thread_cols,
+            "counters": counters,
+            "measured_region": pa1_region.get("measured_region"),
+            "cpupa_tids": pa1_region.get("cpupa_tids", set()),
+        }
+
+    def region_names(self):
+        return list(self.regions)
+
+    def process_ids(self):
+        """The ids of the processes (MPI ranks), if read with `processes`."""
+        assert self.processes, "The processes weren't read (see processes=True)"
+        return list(self.processes)
+
+    def process(self, pid, region_name=None, cmg=None):
+        """The FappXml of only the process `pid` (small enough to be sent
+        to a worker), with `select(region_name, cmg)`."""
+        process = self.processes[pid]
+        fapp_xml = FappXml.__new__(FappXml)
+        fapp_xml.jobs = 1
+        fapp_xml.profiler = NULL_PROFILER
+        fapp_xml.environment = process["environment"]
+        fapp_xml.regions = process["regions"]
+        fapp_xml.processes = OrderedDict([(pid, process)])
+        if self.pack is not None:
+            fapp_xml.pack, fapp_xml.pack_pid = self.pack, pid
+        fapp_xml.select(region_name, cmg)
+        return fapp_xml
+
+    def cmg_ids(self):
+        return sorted({cmg for _, cmg in self.environment["threads"]})
+
+    def select(self, region_name=None, cmg=None):
+        """Point `get_event` and the getters to a region and a CMG (the
+        first ones if None)."""
+        if region_name is None:
+            region_name = next(iter(self.regions), None)
+        if cmg is None:
+            cmg = self.cmg_ids()[0]
+        if region_name not in self.regions:
+            raise NotInProfile(
+                "No events found in the given region! "
+                "Is the correct --roi specified? (see --help)"
+            )
+        region = self.regions[region_name]
+        self.region_name = region_name
+        self.cmg = cmg
+        self.event_rows = region["event_rows"]
+        self.thread_cols = region["thread_cols"]
+        self.counters = region["counters"]
+        self.measured_region = region["measured_region"]
+        self.cpupa_tids = region["cpupa_tids"]
+        self.fill_cmg_tids()
 
     def fill_cmg_tids(self):
-        query = "./environment/spawn/process/thread"
         self.cmg_tids = []
-        for thread in self.xmls[0].findall(query):
-            if self.cmg == int(thread.find("cmg").attrib["id"]):
-                self.cmg_tids.append(thread.attrib["id"])
-        assert len(
-            self.cmg_tids
-        ), "No processes found for given CMG -- this shouldn't happen."
+        for tid, cmg in self.environment["threads"]:
+            if self.cmg == cmg:
+                self.cmg_tids.append(tid)
+        if not self.cmg_tids:
+            raise NotInProfile(
+                "No processes found for given CMG -- this shouldn't happen."
+            )
+        self.cmg_cols = [self.thread_cols.get(tid) for tid in self.cmg_tids]
+
+    def counter(self, event_name, thread_id):
+        """The counter of an event and thread of the selected CMG, or
+        MISSING_COUNTER."""
+        assert 0 <= thread_id, "Wrong thread id"
+        if thread_id >= len(self.cmg_tids):
+            # Rows of the workbook past the threads of the profile are empty.
+            return MISSING_COUNTER
+        col = self.cmg_cols[thread_id]
+        if col is None:
+            return MISSING_COUNTER
+        return self.counters[self.event_rows[event_name] * len(self.thread_cols) + col]
 
     def get_event(self, event_name, thread_id):
-        assert 0 <= thread_id and thread_id < len(self.cmg_tids), "Wrong thread id"
-        result = ""
         if event_name == "LABEL-FAPP-cpupa":
-            query = f"./information/region[@name='{self.region_name}']"
-            query += f"/spawn/process/thread[@id='{thread_id}']"
+            return self.get_label(thread_id, "")
+        value = self.counter(event_name, thread_id)
+        return "" if value == MISSING_COUNTER else value
 
-            if self.xmls[0].findall(f"{query}/cpupa"):
-                result = "FAPP-cpupa"
-            return result
-        else:
-            tid = self.cmg_tids[thread_id]
-            idx = self.event_dict[event_name][0]
-            query = f"./information/region[@name='{self.region_name}']"
-            query += f"/spawn/process/thread[@id='{tid}']"
-            query += f"/cpupa/event[@name='{event_name}']"
-            element = self.xmls[idx].find(query)
-            if element is not None:
-                result = int(element.text)
-        return result
+    def get_float_event(self, event_name, thread_id):
+        """`get_event` with the counters as floats and NaN for empty cells
+        (used by the programs of `xls_parse.py --backend nan`)."""
+        if event_name == "LABEL-FAPP-cpupa":
+            return self.get_label(thread_id, NAN)
+        value = self.counter(event_name, thread_id)
+        return NAN if value == MISSING_COUNTER else float(value)
+
+    def get_label(self, thread_id, empty):
+        assert 0 <= thread_id, "Wrong thread id"
+        if thread_id < len(self.cmg_tids) and str(thread_id) in self.cpupa_tids:
+            return "FAPP-cpupa"
+        return empty
 
     # Single values
     def get_measured_time(self):
-        query = "./environment/measured_time"
-        return self.xmls[0].find(query).text
+        return self.environment["measured_time"]
 
     def get_node_name(self):
-        query = "./environment/spawn/process/host"
-        return self.xmls[0].find(query).get("name")
+        return self.environment["node_name"]
 
     def get_process_no(self):
-        query = "./environment/spawn/process"
-        return int(self.xmls[0].find(query).get("id"))
+        return self.environment["process_no"]
 
     def get_cmg_no(self):
-        query = "./environment/spawn/process/thread/cmg"
-        return int(self.xmls[0].find(query).get("id"))
+        return self.environment["threads"][0][1]
 
     def get_measured_region(self):
-        query = f"./information/region[@name='{self.region_name}']"
-        elem = self.xmls[0].find(query)
-        return [elem.get("name"), int(elem.get("id"))]
+        return self.measured_region
 
     def get_vector_length(self):
-        query = "./environment/vector_length"
-        return int(self.xmls[0].find(query).get("vlen"))
+        return self.environment["vector_length"]
 
     def get_counter_timer_freq(self):
-        query = "./environment/spawn/process/cntfrq"
-        return int(self.xmls[0].find(query).text)
+        return self.environment["counter_timer_freq"]
+
+
+def hash_profile(path):
+    """SHA-256 of the names and contents of the paN.xml files in `path`
+    (or of the archive `path`)."""
+    digest = hashlib.sha256()
+    path = Path(path).expanduser()
+    if path.is_file():
+        files = [path]
+    else:
+        files = sorted(f for f in path.iterdir() if PA_FILE.search(f.name))
+    for file in files:
+        digest.update(file.name.encode())
+        with open(file, "rb") as xml:
+            for chunk in iter(lambda: xml.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory of JSON results addressed by content hashes.
+
+    Hits refresh the modification time of the entry.  The size of the
+    directory is scanned once and then tracked by `put`; once it goes
+    over `max_bytes` the least recently used entries (and the temporary
+    files of crashed writers) are removed until it is below
+    `LOW_WATER * max_bytes`.  Entries are written to a temporary file
+    and renamed, so several processes can share the directory (the
+    size then only accounts for the entries of this process between
+    scans).
+
+    """
+
+    LOW_WATER = 0.9
+    STALE_TMP = 3600  # seconds after which a temporary file is abandoned
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = Path(path).expanduser()
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.files())
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def entry(self, key):
+        return self.path / f"{key}.json"
+
+    def get(self, key):
+        file = self.entry(key)
+        try:
+            with open(file) as entry:
+                value = json.load(entry, object_pairs_hook=OrderedDict)
+            os.utime(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return value
+
+    def put(self, key, value):
+        file = self.entry(key)
+        tmp = file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as entry:
+            json.dump(value, entry)
+        try:
+            self.size -= file.stat().st_size  # replaced
+        except FileNotFoundError:
+            pass
+        self.size += tmp.stat().st_size
+        os.replace(tmp, file)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def files(self):
+        """(modification time, size, path) of the entries and temporary
+        files."""
+        files = []
+        for file in self.path.iterdir():
+            if file.suffix not in (".json", ".tmp"):
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        return files
+
+    def evict(self):
+        files = self.files()
+        total = sum(size for _, size, _ in files)
+        files.sort(key=lambda t: t[0])
+        stale = time.time() - self.STALE_TMP
+        for mtime, size, file in files:
+            if file.suffix == ".tmp" and mtime < stale:
+                file.unlink(missing_ok=True)
+                total -= size
+        for mtime, size, file in files:
+            if total <= self.LOW_WATER * self.max_bytes:
+                break
+            if file.suffix == ".json":
+                file.unlink(missing_ok=True)
+                total -= size
+        self.size = total
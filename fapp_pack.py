@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Pack the paN.xml (or paN.csv) files of profiles into single binary
+files, which `FappXml` memory maps instead of parsing (see `write_pack`):
+
+    python fapp_pack.py $XMLPATH  # writes $XMLPATH.fpk
+    python xls_parse.out.py $XMLPATH.fpk
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from fapp_loader import PA_FILE, PACK_SUFFIX, FappXml, write_pack
+
+
+def profile_size(path):
+    """The bytes of the paN.xml files of a profile (or of an archive)."""
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.iterdir() if PA_FILE.search(f.name))
+
+
+def pack_profile(path, output=None, jobs=1, format=None):
+    path = Path(path).expanduser()
+    output = Path(output or str(path).rstrip("/") + PACK_SUFFIX).expanduser()
+    fapp_xml = FappXml(path, None, None, jobs, format=format, processes=True)
+    write_pack(fapp_xml, output)
+    size, pack_size = profile_size(path), output.stat().st_size
+    print(f"{output}: {pack_size} bytes ({size} bytes of paN files)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "profiles",
+        help="Directories (or archives) of paN.xml files",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--output",
+        help=f"Pack file of a single profile (default: the profile + {PACK_SUFFIX})",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of processes reading the paN.xml files (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--format",
+        help="Read the paN.xml or the paN.csv files (default: xml)",
+        choices=["xml", "csv"],
+    )
+    args = parser.parse_args()
+    assert args.output is None or len(args.profiles) == 1, "--output takes one profile"
+
+    for path in args.profiles:
+        pack_profile(path, args.output, args.jobs, args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Serve the formulas of a generated program over HTTP (on a TCP port or
+a Unix socket), so they are loaded only once:
+
+    GET /?dir=PATH&roi=kernel&cmg=0&output=json&select=KEY&select=KEY
+
+takes the same values as the options of xls_parse.out.py."""
+
+import argparse
+import os
+import socketserver
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from flatten import load_program
+
+# The generated program and the recent loads of a worker (see init_worker).
+WORKER = {}
+QUERY_PARAMETERS = ["dir", "roi", "cmg", "output", "select"]
+
+
+class BadRequest(Exception):
+    """An invalid query, answered with status 400."""
+
+
+class NotFound(Exception):
+    """A region or CMG which isn't in the profile, answered with status
+    404 (like a missing profile)."""
+
+
+class LRU:
+    """The `max_entries` most recently used items of a dict."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_entries:
+            self.items.popitem(last=False)
+
+
+def profile_signature(path):
+    """Names, sizes and modification times of the files of a profile
+    (cheap to get, unlike a hash of the contents)."""
+    path = Path(path).expanduser()
+    files = [path] if path.is_file() else sorted(path.iterdir())
+    return tuple((f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in files)
+
+
+def init_worker(parser, max_entries):
+    WORKER["program"] = load_program(parser)
+    WORKER["loads"] = LRU(max_entries)
+
+
+def evaluate(path, signature, roi, cmg, selection=None):
+    """Results of a profile (in a worker), like xls_parse.out.py."""
+    try:
+        return evaluate_program(WORKER["program"], path, signature, roi, cmg, selection)
+    except WORKER["program"].NotInProfile as e:
+        # (The exceptions of the generated module can't be pickled.)
+        raise NotFound(str(e)) from None
+
+
+def evaluate_program(program, path, signature, roi, cmg, selection):
+    loads = WORKER["loads"]
+    all_regions = roi == "all-regions"
+    all_cmgs = cmg == "all"
+    region_name = None if all_regions else roi
+    # Only the paN.xml files of the selection are loaded.
+    key = (path, signature, region_name, selection)
+    fapp_xml = loads.get(key)
+    if fapp_xml is None:
+        events = program.selected_events(selection)
+        files = program.needed_files(events, program.EVENT_FILES)
+        fapp_xml = program.FappXml(path, region_name, None, files=files)
+        loads.put(key, fapp_xml)
+    if all_regions or all_cmgs:
+        region_names = fapp_xml.region_names() if all_regions else [region_name]
+        cmgs = fapp_xml.cmg_ids() if all_cmgs else [int(cmg)]
+        return program.compute_all(fapp_xml, region_names, cmgs, None, selection)
+    fapp_xml.select(region_name, int(cmg))
+    if selection:
+        return program.selected_compute(selection)(fapp_xml)
+    return program.compute(fapp_xml)
+
+
+class Service:
+    def __init__(self, parser, jobs=1, max_entries=128):
+        self.program = load_program(parser)
+        self.pool = ProcessPoolExecutor(
+            jobs or None, initializer=init_worker, initargs=(parser, max_entries)
+        )
+        self.results = LRU(max_entries)
+        self.lock = threading.Lock()  # of `results`
+
+    def check(self, cmg, output, selection):
+        """Raise BadRequest for values xls_parse.out.py would reject, so
+        only errors of the query are reported as such."""
+        if output not in self.program.OUTPUT_FUNCS:
+            raise BadRequest(f"Unknown output {output}")
+        if cmg != "all" and not cmg.isdigit():
+            raise BadRequest(f"Invalid cmg {cmg}")
+        if selection:
+            try:
+                self.program.selected_compute(selection)
+            except AssertionError as e:
+                raise BadRequest(str(e))
+
+    def handle(self, path, roi="all", cmg="0", output="json", select=None):
+        selection = tuple(select) if select else None
+        self.check(cmg, output, selection)
+        path = str(Path(path).expanduser().resolve())
+        key = (path, profile_signature(path), roi, cmg, selection)
+        with self.lock:
+            results = self.results.get(key)
+        if results is None:
+            results = self.pool.submit(evaluate, *key).result()
+            with self.lock:
+                self.results.put(key, results)
+        return self.program.format_output(results, output) + "\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def query_args(self):
+        """The arguments of `Service.handle` in the query string."""
+        query = parse_qs(urlparse(self.path).query)
+        unknown = [k for k in query if k not in QUERY_PARAMETERS]
+        if unknown:
+            raise BadRequest(f"Unknown parameters {', '.join(unknown)}")
+        if "dir" not in query:
+            raise BadRequest("Missing dir")
+        select = query.pop("select", None)  # the only repeated parameter
+        args = {k: v[-1] for k, v in query.items()}
+        args["path"] = args.pop("dir")
+        return dict(args, select=select)
+
+    def do_GET(self):
+        try:
+            body = self.service.handle(**self.query_args())
+            status = 200
+        except BadRequest as e:
+            body, status = f"Bad request: {e}\n", 400
+        except (NotFound, FileNotFoundError, NotADirectoryError) as e:
+            body, status = f"{e}\n", 404
+        except Exception as e:
+            self.log_error("Failed to compute %s: %r", self.path, e)
+            body, status = f"Internal error: {e!r}\n", 500
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--parser",
+        help="Generated module with the formulas (default: xls_parse_out.py)",
+        default="xls_parse_out.py",
+    )
+    parser.add_argument(
+        "--port", help="TCP port on localhost (default: 8000)", type=int, default=8000
+    )
+    parser.add_argument("--socket", help="Listen on this Unix socket instead")
+    parser.add_argument(
+        "--jobs",
+        help="Number of worker processes (default: 1, 0: all cores)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--entries",
+        help="Number of results, and of loaded profiles per worker, kept in "
+        "memory (default: 128)",
+        type=int,
+        default=128,
+    )
+    args = parser.parse_args()
+
+    Handler.service = Service(args.parser, args.jobs, args.entries)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+    else:
+        server = ThreadingHTTPServer(("localhost", args.port), Handler)
+    with server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Generate synthetic paN.xml sets (as written by `fapp -A -txml`) with
+random counters, e.g. for benchmarking (see bench.py)."""
+
+import argparse
+import csv
+import io
+import random
+import re
+from pathlib import Path
+
+from fapp_loader import CSV_COUNTERS, CSV_THREADS, read_pa_xml
+
+NUM_FILES = 17
+TIMER_EVENTS = ["CNTVCT", "PMCCNTR"]  # recorded in every paN.xml
+
+
+def default_events(per_file=18):
+    return [f"0x{idx:04x}" for idx in range(NUM_FILES * per_file)]
+
+
+def program_events(program):
+    """The event names read by a generated program."""
+    source = Path(program).expanduser().read_text()
+    names = re.findall(r"get_(?:float_)?event\('([^']*)'", source)
+    skip = set(TIMER_EVENTS) | {"LABEL-FAPP-cpupa"}
+    return list(dict.fromkeys(n for n in names if n not in skip))
+
+
+def split_events(events):
+    """Distribute the events over the 17 files (round robin)."""
+    return [events[idx::NUM_FILES] for idx in range(NUM_FILES)]
+
+
+def pa_xml(
+    events,
+    regions=("all", "kernel"),
+    procs=1,
+    threads=12,
+    cmgs=4,
+    missing=0.0,
+    rng=random,
+):
+    threads = threads * cmgs
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<fapp>",
+        " <environment>",
+        "  <measured_time>2022/03/01 12:00:00</measured_time>",
+        '  <vector_length vlen="512"/>',
+        '  <spawn id="0">',
+    ]
+    for proc in range(procs):
+        lines += [
+            f'   <process id="{proc}">',
+            f'    <host name="node{proc}"/>',
+            "    <cntfrq>100000000</cntfrq>",
+        ]
+        for tid in range(threads):
+            cmg = tid * cmgs // threads
+            lines.append(f'    <thread id="{tid}"><cmg id="{cmg}"/></thread>')
+        lines.append("   </process>")
+    lines += ["  </spawn>", " </environment>", " <information>"]
+    for region_id, region in enumerate(regions):
+        lines += [f'  <region name="{region}" id="{region_id}">', '   <spawn id="0">']
+        for proc in range(procs):
+            lines.append(f'    <process id="{proc}">')
+            for tid in range(threads):
+                lines.append(f'     <thread id="{tid}"><cpupa>')
+                for name in TIMER_EVENTS + events:
+                    if name not in TIMER_EVENTS and rng.random() < missing:
+                        continue
+                    value = rng.randrange(1, 10**9)
+                    lines.append(f'      <event name="{name}">{value}</event>')
+                lines.append("     </cpupa></thread>")
+            lines.append("    </process>")
+        lines += ["   </spawn>", "  </region>"]
+    lines += [" </information>", "</fapp>"]
+    return "\n".join(lines) + "\n"
+
+
+def pa_csv(*args, **kwargs):
+    """The paN.csv (in the layout read by `read_pa_csv`) of the `pa_xml`
+    with the same arguments."""
+    xml = read_pa_xml(io.BytesIO(pa_xml(*args, **kwargs).encode()), processes=True)
+    environment = xml["environment"]
+    processes = xml["processes"].values()
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["Measured time", environment["measured_time"]])
+    writer.writerow(["Vector length", environment["vector_length"]])
+    writer.writerow(["Timer frequency", environment["counter_timer_freq"]])
+    writer.writerow([])
+    writer.writerow(CSV_THREADS)
+    for process in processes:
+        env = process["environment"]
+        for tid, cmg in env["threads"]:
+            writer.writerow([env["process_no"], env["node_name"], tid, cmg])
+    writer.writerow([])
+    events = list(dict.fromkeys(TIMER_EVENTS + args[0]))
+    writer.writerow(CSV_COUNTERS + events)
+    for name in xml["regions"]:
+        for process in processes:
+            env, region = process["environment"], process["regions"][name]
+            for tid, _ in env["threads"]:
+                values = [region["events"].get(e, {}).get(tid, "") for e in events]
+                row = [name, region["measured_region"][1], env["process_no"], tid]
+                writer.writerow(row + values)
+    return out.getvalue()
+
+
+def write_profile(path, events=None, seed=0, format="xml", **kwargs):
+    """Write pa1.xml ... pa17.xml (or .csv) into the directory `path`."""
+    rng = random.Random(seed)
+    path = Path(path).expanduser()
+    path.mkdir(parents=True, exist_ok=True)
+    write = pa_csv if format == "csv" else pa_xml
+    for idx, file_events in enumerate(split_events(events or default_events())):
+        text = write(file_events, rng=rng, **kwargs)
+        (path / f"pa{idx + 1}.{format}").write_text(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir", help="Directory of the paN.xml files")
+    parser.add_argument(
+        "--program",
+        help="Generate the events read by this generated program "
+        "(default: 17 x 18 events named 0x0000, 0x0001, ...)",
+    )
+    parser.add_argument(
+        "--regions",
+        help="Comma separated region names (default: all,kernel)",
+        default="all,kernel",
+    )
+    parser.add_argument("--procs", help="Processes (default: 1)", type=int, default=1)
+    parser.add_argument(
+        "--threads", help="Threads per CMG (default: 12)", type=int, default=12
+    )
+    parser.add_argument("--cmgs", help="CMGs (default: 4)", type=int, default=4)
+    parser.add_argument(
+        "--missing",
+        help="Probability of an event being left out of a thread (default: 0)",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--format",
+        help="Write paN.xml (fapp -txml) or paN.csv files (default: xml)",
+        choices=["xml", "csv"],
+        default="xml",
+    )
+    args = parser.parse_args()
+
+    events = program_events(args.program) if args.program else None
+    write_profile(
+        args.output_dir,
+        events,
+        seed=args.seed,
+        format=args.format,
+        regions=args.regions.split(","),
+        procs=args.procs,
+        threads=args.threads,
+        cmgs=args.cmgs,
+        missing=args.missing,
+    )
+
+
+if __name__ == "__main__":
+    main()
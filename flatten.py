@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 
 import argparse
+import importlib.util
 import json
-import subprocess
+import os
+import queue
+import signal
 import sys
+import time
 from collections import OrderedDict
+from multiprocessing import Pool
 from pathlib import Path
 
-from fapp_loader import FappXml
+from fapp_loader import PA_FILE, FappXml, ResultCache, hash_profile
+
+NUM_PA_FILES = 17
+ALL_PA_FILES = set(range(1, NUM_PA_FILES + 1))
+RAW_ROI = "kernel"  # the region of the raw counter columns
+
+# The generated program, ROI and cache of a worker (see init_worker).
+WORKER = {}
 
 
 def flatten(data: OrderedDict) -> list:
@@ -22,12 +34,28 @@ def flatten(data: OrderedDict) -> list:
     return results
 
 
-def get_ordered_dict(xml_dir: str, parser: str) -> OrderedDict:
+def load_program(parser: str):
+    """Import the generated module (or the module behind its CLI)."""
     script = Path(parser).expanduser()
-    cmd = ["python", script, xml_dir]
-    json_out = subprocess.run(cmd, stdout=subprocess.PIPE)
-    result = json.loads(json_out.stdout, object_pairs_hook=OrderedDict)
-    return result
+    sys.path.insert(0, str(script.resolve().parent))
+    spec = importlib.util.spec_from_file_location(script.stem.replace(".", "_"), script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def init_worker(parser: str, roi: str, cache_dir=None, cache_size=1024):
+    WORKER["program"] = load_program(parser)
+    WORKER["roi"] = roi
+    WORKER["cache"] = None
+    if cache_dir is not None:
+        WORKER["cache"] = ResultCache(cache_dir, cache_size << 20)
+
+
+def init_watch_worker(*args):
+    # Interrupting `watch` terminates the pool, not the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(*args)
 
 
 def get_measurements(pairs: list):
@@ -36,24 +64,408 @@ def get_measurements(pairs: list):
     return results
 
 
-def proc_all_files(infile, parser):
+def proc_dir(xml_dir: str) -> OrderedDict:
+    """Derived metrics and raw counters of a directory, from one load."""
+    program, roi, cache = WORKER["program"], WORKER["roi"], WORKER["cache"]
+    if cache is not None:
+        fingerprint = program.PROGRAM_FINGERPRINT
+        key = cache.key(hash_profile(xml_dir), roi, "flatten", fingerprint)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    # Every region is loaded: the raw counters are always those of the
+    # first thread of RAW_ROI, whatever the region of the metrics.
+    fapp_xml = FappXml(xml_dir, None, None)
+    fapp_xml.select(roi, 0)
+    result = OrderedDict()
+    result["results"] = program.compute(fapp_xml)
+    fapp_xml.select(RAW_ROI, 0)
+    result["raw"] = OrderedDict(
+        (k, fapp_xml.get_event(k, 0)) for k in fapp_xml.event_rows
+    )
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def benchmark_name(xml_dir: str) -> str:
+    return Path(xml_dir).expanduser().name.split(".")[0]
+
+
+def row_values(row):
+    """The column names and the values of a `proc_dir` result."""
+    pairs = flatten(row["results"])
+    keys = [pair[0] for pair in pairs] + list(row["raw"].keys())
+    return keys, get_measurements(pairs) + list(row["raw"].values())
+
+
+def proc_rows(lines, parser, roi="all", jobs=1, cache_dir=None, cache_size=1024):
+    """Yield the column names and the values of each directory in `lines`."""
+    initargs = (parser, roi, cache_dir, cache_size)
+    if jobs == 1:
+        init_worker(*initargs)
+        rows = map(proc_dir, lines)
+    else:
+        pool = Pool(jobs or None, init_worker, initargs)
+        # imap yields in input order, as soon as the previous rows are done.
+        rows = pool.imap(proc_dir, lines)
+    for row in rows:
+        yield row_values(row)
+    if jobs != 1:
+        pool.close()
+        pool.join()
+
+
+def proc_all_files(infile, parser, roi="all", jobs=1, cache_dir=None, cache_size=1024):
     first = True
     sep = "\t"
-    for line in infile.readlines():
-        line = line.strip()
-        benchmark = Path(line).expanduser().name.split(".")[0]
-        json_dict = get_ordered_dict(line, parser)
-        pairs = flatten(json_dict)
-        fapp_xml = FappXml(line)
-        raw_keys = list(fapp_xml.event_dict.keys())
-        raw_counters = [fapp_xml.get_event(k, 0) for k in raw_keys]
-        measurements = get_measurements(pairs)
+    lines = [line.strip() for line in infile.readlines()]
+    rows = proc_rows(lines, parser, roi, jobs, cache_dir, cache_size)
+    for line, (keys, values) in zip(lines, rows):
         if first:
             first = False
-            keys = [pair[0] for pair in pairs] + raw_keys
             print(sep.join(["Benchmark"] + keys))
-        values = measurements + raw_counters
-        print(sep.join([benchmark] + [str(v) for v in values]))
+        print(sep.join([benchmark_name(line)] + [str(v) for v in values]), flush=True)
+
+
+def encode_column(values):
+    """Typed NumPy array of a column: int64 or float64 (NaN for empty
+    cells) for numbers, (row x thread) float64 for per-thread lists, and
+    strings otherwise."""
+    import numpy as np
+
+    def is_number(v):
+        return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+    if all(is_number(v) and isinstance(v, int) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(is_number(v) or v == "" for v in values):
+        return np.array([np.nan if v == "" else v for v in values], dtype=float)
+    if any(isinstance(v, list) for v in values):
+        rows = [v if isinstance(v, list) else [v] for v in values]
+        if all(is_number(e) or e == "" for row in rows for e in row):
+            width = max(len(row) for row in rows)
+            result = np.full((len(rows), width), np.nan)
+            for idx, row in enumerate(rows):
+                result[idx, : len(row)] = [np.nan if e == "" else e for e in row]
+            return result
+    return np.array([str(v) for v in values])
+
+
+def concat_columns(pieces):
+    import numpy as np
+
+    if all(p.ndim == 2 for p in pieces):
+        # Pad the per-thread columns to the largest number of threads.
+        width = max(p.shape[1] for p in pieces)
+        pieces = [
+            np.pad(p, ((0, 0), (0, width - p.shape[1])), constant_values=np.nan)
+            for p in pieces
+        ]
+    try:
+        return np.concatenate(pieces)
+    except (ValueError, TypeError):
+        # Different types or thread counts in different chunks.
+        values = [v for piece in pieces for v in piece.tolist()]
+        result = np.empty(len(values), dtype=object)
+        result[:] = values
+        return result
+
+
+class ColumnStore:
+    """Directory of flatten results which grows one NPZ chunk per run.
+
+    `manifest.json` lists the chunks with their column names, and for
+    each processed directory the chunk and row holding its latest
+    results, the content hash of its paN.xml files and a key of the
+    hash, the ROI and the generated program.  Directories whose key is
+    unchanged are skipped by `update`; the rows of changed directories
+    are appended to the new chunk and the old rows are ignored.
+
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest = {"chunks": [], "dirs": {}}
+        if (self.path / self.MANIFEST).exists():
+            with open(self.path / self.MANIFEST) as manifest:
+                self.manifest = json.load(manifest)
+
+    def save_manifest(self):
+        file = self.path / self.MANIFEST
+        tmp = file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as manifest:
+            json.dump(self.manifest, manifest, indent=1)
+        os.replace(tmp, file)
+
+    def stale(self, keys):
+        """The directories (keys of `keys`) which aren't stored with the
+        given key yet."""
+        dirs = self.manifest["dirs"]
+        return [d for d, key in keys.items() if dirs.get(d, {}).get("key") != key]
+
+    def append(self, xml_dirs, rows, keys, hashes):
+        """Store the `rows` ((column names, values) pairs) of `xml_dirs` in
+        a new chunk."""
+        import numpy as np
+
+        columns = {}
+        for names, _ in rows:
+            for name in names:
+                columns.setdefault(name, [])
+        for names, values in rows:
+            row = dict(zip(names, values))
+            for name, column in columns.items():
+                column.append(row.get(name, ""))
+        names = list(columns)
+        chunk = f"chunk-{len(self.manifest['chunks']):05d}.npz"
+        arrays = {
+            f"c{idx}": encode_column(columns[name]) for idx, name in enumerate(names)
+        }
+        arrays["benchmark"] = np.array([benchmark_name(d) for d in xml_dirs])
+        np.savez(self.path / chunk, **arrays)
+        self.manifest["chunks"].append({"file": chunk, "columns": names})
+        for idx, xml_dir in enumerate(xml_dirs):
+            self.manifest["dirs"][xml_dir] = {
+                "chunk": chunk,
+                "row": idx,
+                "hash": hashes[xml_dir],
+                "key": keys[xml_dir],
+            }
+        self.save_manifest()
+
+    def chunks(self):
+        """OrderedDicts of the columns (with "Benchmark" first) of the
+        latest rows stored in each chunk, one chunk at a time."""
+        import numpy as np
+
+        dirs = self.manifest["dirs"].values()
+        for chunk in self.manifest["chunks"]:
+            rows = [d["row"] for d in dirs if d["chunk"] == chunk["file"]]
+            if not rows:
+                continue
+            with np.load(self.path / chunk["file"]) as arrays:
+                columns = OrderedDict([("Benchmark", arrays["benchmark"][rows])])
+                for idx, name in enumerate(chunk["columns"]):
+                    columns[name] = arrays[f"c{idx}"][rows]
+            yield columns
+
+    def load(self):
+        """OrderedDict of the columns (with "Benchmark" first) holding the
+        latest row of every stored directory."""
+        import numpy as np
+
+        result = OrderedDict()
+        num_rows = 0
+        for columns in self.chunks():
+            for name, column in columns.items():
+                if name not in result:
+                    result[name] = [np.full(num_rows, np.nan)] if num_rows else []
+                result[name].append(column)
+            num_rows += len(columns["Benchmark"])
+            for pieces in result.values():
+                missing = num_rows - sum(len(p) for p in pieces)
+                if missing:
+                    pieces.append(np.full(missing, np.nan))
+        return OrderedDict((k, concat_columns(v)) for k, v in result.items() if v)
+
+
+def update_store(infile, store_dir, parser, roi="all", jobs=1, **cache):
+    """Process the directories of `infile` which are new or changed since
+    the last update of the store in `store_dir`."""
+    store = ColumnStore(store_dir)
+    lines = [line.strip() for line in infile.readlines() if line.strip()]
+    fingerprint = load_program(parser).PROGRAM_FINGERPRINT
+    hashes = {line: hash_profile(line) for line in lines}
+    keys = {line: ResultCache.key(h, roi, fingerprint) for line, h in hashes.items()}
+    stale = store.stale(keys)
+    if stale:
+        rows = list(proc_rows(stale, parser, roi, jobs, **cache))
+        store.append(stale, rows, keys, hashes)
+    print(
+        f"{len(stale)} new or changed, {len(lines) - len(stale)} unchanged",
+        file=sys.stderr,
+    )
+
+
+def complete_dirs(root, skip=()):
+    """Yield the directories under `root` (except `skip`) with all of the
+    pa1.xml ... pa17.xml files (maybe compressed), and the names,
+    sizes and modification times of these files."""
+    for dirpath, _, filenames in os.walk(root):
+        if dirpath in skip:
+            continue
+        matches = {n: PA_FILE.search(n) for n in filenames}
+        names = sorted(n for n, m in matches.items() if m and m.group(2) == "xml")
+        if not ALL_PA_FILES <= {int(matches[n].group(1)) for n in names}:
+            continue
+        try:
+            stats = [os.stat(os.path.join(dirpath, n)) for n in names]
+        except FileNotFoundError:
+            continue  # being renamed or removed
+        yield dirpath, tuple(
+            (n, st.st_size, st.st_mtime) for n, st in zip(names, stats)
+        )
+
+
+class Watcher:
+    """Complete profile directories under `root` whose files are no
+    longer being written: their names, sizes and modification times
+    didn't change for `settle` seconds, or their newest file is older
+    than that (e.g. directories written before the watch started, or
+    moved in).  Directories in `failed` are only ready again once their
+    files changed."""
+
+    def __init__(self, root, settle=10.0):
+        self.root = root
+        self.settle = settle
+        self.pending = {}  # directory -> (files, time first seen with them)
+        self.failed = {}  # directory -> files it couldn't be processed with
+
+    def ready(self, skip=()):
+        """The ready directories (except `skip`) and their files."""
+        now = time.monotonic()
+        result = {}
+        for xml_dir, files in complete_dirs(self.root, skip):
+            if self.failed.get(xml_dir) == files:
+                continue
+            old = self.pending.get(xml_dir)
+            if old is None or old[0] != files:
+                self.pending[xml_dir] = old = (files, now)
+            newest = max(mtime for _, _, mtime in files)
+            if now - old[1] >= self.settle or time.time() - newest >= self.settle:
+                del self.pending[xml_dir]
+                result[xml_dir] = files
+        return result
+
+
+class TsvTable:
+    """TSV file the rows are appended to, with the list of the
+    directories of these rows in `path`.done."""
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.done_path = self.path.with_name(self.path.name + ".done")
+        self.done = set()
+        if self.done_path.exists():
+            self.done = set(self.done_path.read_text().splitlines())
+        self.header = self.path.exists() and self.path.stat().st_size > 0
+
+    def stale(self, xml_dirs):
+        return [d for d in xml_dirs if d not in self.done]
+
+    def append(self, xml_dirs, rows):
+        sep = "\t"
+        with open(self.path, "a") as table:
+            for xml_dir, (keys, values) in zip(xml_dirs, rows):
+                if not self.header:
+                    self.header = True
+                    print(sep.join(["Benchmark"] + keys), file=table)
+                values = [benchmark_name(xml_dir)] + [str(v) for v in values]
+                print(sep.join(values), file=table)
+        # A crash in between repeats the rows, but never loses them.
+        with open(self.done_path, "a") as done:
+            done.writelines(f"{d}\n" for d in xml_dirs)
+        self.done.update(xml_dirs)
+
+
+class StoreTable:
+    """`ColumnStore` the rows are appended to, skipping the directories
+    stored with the same key (see `update_store`)."""
+
+    def __init__(self, path, roi, fingerprint):
+        self.store = ColumnStore(path)
+        self.roi = roi
+        self.fingerprint = fingerprint
+        self.hashes = {}
+        self.keys = {}
+
+    def stale(self, xml_dirs):
+        for xml_dir in xml_dirs:
+            self.hashes[xml_dir] = hash_profile(xml_dir)
+            key = ResultCache.key(self.hashes[xml_dir], self.roi, self.fingerprint)
+            self.keys[xml_dir] = key
+        return self.store.stale({d: self.keys[d] for d in xml_dirs})
+
+    def append(self, xml_dirs, rows):
+        self.store.append(list(xml_dirs), list(rows), self.keys, self.hashes)
+
+
+def watch(
+    root,
+    parser,
+    roi="all",
+    jobs=1,
+    outfile=None,
+    store_dir=None,
+    interval=5.0,
+    settle=10.0,
+    cache_dir=None,
+    cache_size=1024,
+):
+    """Process the profile directories appearing under `root` (see
+    `Watcher`) on a pool of `jobs` workers until interrupted, and append
+    the row of each to the TSV `outfile` (or the store in `store_dir`)
+    as soon as it is done.  Directories already in the table are
+    skipped, so a restarted watch continues where it stopped, and
+    directories which failed are retried once their files change."""
+    root = str(Path(root).expanduser().resolve())
+    if store_dir is not None:
+        fingerprint = load_program(parser).PROGRAM_FINGERPRINT
+        table = StoreTable(store_dir, roi, fingerprint)
+    else:
+        table = TsvTable(outfile)
+    watcher = Watcher(root, settle)
+    seen = set()
+    submitted = {}  # directory -> its files, until done
+    results = queue.Queue()  # (directory, row or exception) of the workers
+    running = 0
+    initargs = (parser, roi, cache_dir, cache_size)
+    pool = Pool(jobs or None, init_watch_worker, initargs)
+    try:
+        while True:
+            ready = watcher.ready(seen)
+            seen.update(ready)
+            for xml_dir in table.stale(list(ready)):
+                submitted[xml_dir] = ready[xml_dir]
+                pool.apply_async(
+                    proc_dir,
+                    (xml_dir,),
+                    callback=lambda row, d=xml_dir: results.put((d, row)),
+                    error_callback=lambda e, d=xml_dir: results.put((d, e)),
+                )
+                running += 1
+            deadline = time.monotonic() + interval
+            while time.monotonic() < deadline:
+                try:
+                    done = [results.get(timeout=deadline - time.monotonic())]
+                except queue.Empty:
+                    break
+                while not results.empty():
+                    done.append(results.get())
+                running -= len(done)
+                rows = []
+                for xml_dir, row in done:
+                    files = submitted.pop(xml_dir)
+                    if isinstance(row, BaseException):
+                        print(f"{xml_dir}: {row!r}", file=sys.stderr)
+                        seen.discard(xml_dir)
+                        watcher.failed[xml_dir] = files
+                    else:
+                        watcher.failed.pop(xml_dir, None)
+                        rows.append((xml_dir, row_values(row)))
+                if rows:
+                    table.append(*zip(*rows))
+                print(
+                    f"{len(rows)} added, {running} running", file=sys.stderr, flush=True
+                )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
 
 
 def main():
@@ -63,18 +475,86 @@ def main():
         "--parser",
         help="Parser for the xml files",
         type=str,
-        default="xls_parse.out.py",
+        default="xls_parse_out.py",
+    )
+    parser.add_argument(
+        "--roi",
+        help="Region of the derived metrics (default: all; the raw counters "
+        f"are those of {RAW_ROI})",
+        default="all",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of worker processes (default: 1, 0: all cores)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory of cached rows (default: no cache)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Size limit of --cache-dir in MiB (default: 1024)",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--store",
+        help="Append the rows of new or changed directories to this columnar "
+        "store (NPZ chunks and a manifest) instead of printing a TSV",
+    )
+    parser.add_argument(
+        "--watch",
+        help="Instead of reading --infile, watch this directory for profile "
+        "directories (with all of pa1.xml ... pa17.xml) and append their rows "
+        "to --outfile or --store as they are completed",
+    )
+    parser.add_argument("--outfile", help="TSV file the rows of --watch go to")
+    parser.add_argument(
+        "--interval",
+        help="Seconds between the scans of --watch (default: 5)",
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--settle",
+        help="Seconds the files of a directory must stay unchanged before "
+        "--watch processes it (default: 10)",
+        type=float,
+        default=10.0,
     )
     args = parser.parse_args()
+    cache = {"cache_dir": args.cache_dir, "cache_size": args.cache_size}
+    if args.watch is not None:
+        assert (args.outfile is None) != (
+            args.store is None
+        ), "--watch takes either --outfile or --store"
+        watch(
+            args.watch,
+            args.parser,
+            args.roi,
+            args.jobs,
+            args.outfile,
+            args.store,
+            args.interval,
+            args.settle,
+            **cache,
+        )
+        return
     if args.infile is None:
         infile = sys.stdin
     else:
         infile = open(args.infile)
 
-    proc_all_files(infile, args.parser)
+    if args.store is not None:
+        update_store(infile, args.store, args.parser, args.roi, args.jobs, **cache)
+    else:
+        proc_all_files(infile, args.parser, args.roi, args.jobs, **cache)
 
     if infile is not sys.stdin:
         infile.close()
 
 
-main()
+if __name__ == "__main__":
+    main()
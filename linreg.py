@@ -2,7 +2,9 @@
 
 
 import argparse
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 from sklearn.linear_model import LinearRegression
@@ -12,7 +14,7 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--derived_path",
-        help="TSV from xml/xls flatten script",
+        help="TSV (or --store directory) from xml/xls flatten script",
         default="~/Sync/all.tsv",
     )
     parser.add_argument(
@@ -20,6 +22,12 @@ def get_args():
         help="TSV from google sheets",
         default="~/Sync/polybench.tsv",
     )
+    parser.add_argument(
+        "--chunksize",
+        help="Fit out-of-core, reading this many rows of the derived TSV (or "
+        "of the --store directory) at a time",
+        type=int,
+    )
     return parser.parse_args()
 
 
@@ -31,19 +39,50 @@ def get_raw_counter_keys(columns):
     return results
 
 
+LAST_REMOVED_COL = 8
+
+
+def get_numbers(merged: pd.DataFrame) -> pd.DataFrame:
+    numbers = merged.iloc[:, LAST_REMOVED_COL:]
+    # print(f"Remaining cols: {len(numbers.columns)}")
+
+    all_numeric = all([is_numeric_dtype(numbers[c]) for c in numbers.columns])
+    assert all_numeric, "Some of the remaining columns are not numeric"
+    return numbers
+
+
+def column_frame(columns) -> pd.DataFrame:
+    # Per-thread (2D) columns become columns of lists, like in the TSV.
+    return pd.DataFrame({k: list(v) if v.ndim > 1 else v for k, v in columns.items()})
+
+
+def store_chunks(derived_path: str, chunksize: int):
+    """The stored columns as frames of at most `chunksize` rows."""
+    from flatten import ColumnStore
+
+    for columns in ColumnStore(derived_path).chunks():
+        num_rows = len(columns["Benchmark"])
+        for start in range(0, num_rows, chunksize):
+            part = {k: v[start : start + chunksize] for k, v in columns.items()}
+            yield column_frame(part)
+
+
 def get_data(
     derived_path: str,
     diffs_path: str,
     verbose: bool = False,
 ) -> pd.DataFrame:
-    last_removed_col = 8
+    if Path(derived_path).expanduser().is_dir():
+        from flatten import ColumnStore
 
-    derived = pd.read_csv(derived_path, sep="\t")
+        derived = column_frame(ColumnStore(derived_path).load())
+    else:
+        derived = pd.read_csv(derived_path, sep="\t")
     diffs = pd.read_csv(diffs_path, sep="\t")
     merged = pd.merge(derived, diffs, on="Benchmark")
 
     if verbose:
-        removed_cols = merged.iloc[:, :last_removed_col].columns
+        removed_cols = merged.iloc[:, :LAST_REMOVED_COL].columns
         print(f"Removed cols: {[c for c in removed_cols]}")
         fapp_time_col = "Statistics::Execution time (s)"
         chip_time_col = "A64fx time"
@@ -52,12 +91,21 @@ def get_data(
         print(selected_cols.assign(quotient=quotient_col))
         print(f"quotient: min={min(quotient_col)}, max={max(quotient_col)}")
 
-    numbers = merged.iloc[:, last_removed_col:]
-    # print(f"Remaining cols: {len(numbers.columns)}")
+    return get_numbers(merged)
 
-    all_numeric = all([is_numeric_dtype(numbers[c]) for c in numbers.columns])
-    assert all_numeric, "Some of the remaining columns are not numeric"
-    return numbers
+
+def get_data_chunks(derived_path: str, diffs_path: str, chunksize: int):
+    """The `get_data` of `chunksize` rows of the derived data at a time
+    (only the diffs are read at once)."""
+    diffs = pd.read_csv(diffs_path, sep="\t")
+    if Path(derived_path).expanduser().is_dir():
+        chunks = store_chunks(derived_path, chunksize)
+    else:
+        chunks = pd.read_csv(derived_path, sep="\t", chunksize=chunksize)
+    for derived in chunks:
+        merged = pd.merge(derived, diffs, on="Benchmark")
+        if len(merged):
+            yield get_numbers(merged)
 
 
 def normalise(
@@ -76,6 +124,60 @@ def normalise(
     return X, y
 
 
+class Moments:
+    """Count, means and centered scatter matrix of the rows of [X y],
+    merged chunk by chunk (Chan et al.), which is all the least squares
+    fit needs.  Centering each chunk keeps the large raw counter values
+    from cancelling out."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.scatter = None
+
+    def add(self, X, y):
+        data = np.column_stack([X, y]).astype(float)
+        count = len(data)
+        mean = data.mean(axis=0)
+        centered = data - mean
+        scatter = centered.T @ centered
+        if self.count == 0:
+            self.count, self.mean, self.scatter = count, mean, scatter
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.scatter += scatter + np.outer(delta, delta) * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+
+    def fit(self):
+        """Coefficients, intercept and R^2 score, as `LinearRegression`
+        (minimum norm coefficients if the columns are dependent)."""
+        sxx = self.scatter[:-1, :-1]
+        sxy = self.scatter[:-1, -1]
+        syy = self.scatter[-1, -1]
+        coef = np.linalg.lstsq(sxx, sxy, rcond=None)[0]
+        intercept = self.mean[-1] - self.mean[:-1] @ coef
+        residual = syy - 2 * coef @ sxy + coef @ sxx @ coef
+        return coef, intercept, 1 - residual / syy
+
+
+def fit_chunks(derived_path: str, diffs_path: str, chunksize: int):
+    """Fit the regression of `main` without holding all the rows in
+    memory."""
+    moments = Moments()
+    columns = None
+    for data in get_data_chunks(derived_path, diffs_path, chunksize):
+        norm_cols = get_raw_counter_keys(data.columns)
+        X, y = normalise(data.copy(), norm_cols)
+        if columns is None:
+            columns = list(X.columns)
+        assert list(X.columns) == columns, "The chunks have different columns"
+        moments.add(X.to_numpy(), y.to_numpy())
+    assert columns is not None, "No rows of the derived data are in the diffs"
+    return columns, *moments.fit()
+
+
 def print_results(coefs, n=5):
     fmt_str = "{:0.10} : {}"
     print("Top:")
@@ -93,6 +195,16 @@ def print_results(coefs, n=5):
 
 def main():
     args = get_args()
+    if args.chunksize:
+        columns, coef, intercept, score = fit_chunks(
+            args.derived_path, args.diffs_path, args.chunksize
+        )
+        print(f"Score: {score}")
+        coefs = sorted(zip(columns, coef), key=lambda t: t[1], reverse=True)
+        print_results(coefs)
+        print(intercept)
+        return
+
     data = get_data(args.derived_path, args.diffs_path, verbose=True)
     norm_cols = get_raw_counter_keys(data.columns)
     X, y = normalise(data, norm_cols)
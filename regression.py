@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Regression checks of xls_parse.py on a small synthetic workbook (see
+`write_workbook`) and synthetic profiles (see fapp_synth.py):
+
+    python regression.py
+
+checks that an incremental transpilation (see --record) writes the same
+program as a fresh one, and that the optimizing passes, the loops over
+the threads and the nan backend don't change the results.  Exits with
+status 1 if any check fails."""
+
+import argparse
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import openpyxl
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+
+import fapp_synth
+from bench import REPO, TRANSPILER_FILES
+
+# The singles and tables read by `add_tables` in xls_parse.py.
+SINGLES = [("A3", "C3"), ("A4", "C4"), ("H3", "J3"), ("H5", "J5")]
+SINGLES += [("O3", "Q3"), ("O4", "Q4")]
+TABLES = [
+    (["A8"], "C", "N", 8, 14),
+    (["P8", "R8"], "R", "S", 9, 14),
+    (["P8", "T8"], "T", "Y", 9, 14),
+    (["P8", "Z8"], "Z", "AA", 9, 14),
+    (["P8", "AB8"], "AB", "AC", 9, 14),
+    (["P8"], "AD", "AG", 8, 14),
+    (["P8", "AH8"], "AH", "AK", 9, 14),
+    (["P8"], "AL", "AL", 8, 14),
+    (["A28"], "C", "P", 28, 34),
+    (["A48"], "C", "P", 48, 55),
+    (["A69", "C69", "C70", "C71"], "C", "I", 72, 77),
+    (["A69", "C69", "C70", "J71"], "J", "J", 72, 77),
+    (["A69", "C69", "K70", "K71"], "K", "O", 72, 77),
+    (["A69", "C69", "K70", "P71"], "P", "P", 72, 77),
+    (["A69", "Q69"], "Q", "S", 70, 77),
+    (["A69"], "T", "T", 69, 77),
+    (["A69", "U69"], "U", "W", 70, 77),
+    (["A69", "X69"], "X", "Y", 71, 77),
+    (["A69"], "Z", "AE", 69, 77),
+    (["AG69"], "AI", "AK", 69, 77),
+    (["A92", "C92"], "C", "E", 93, 98),
+    (["A92", "F92"], "F", "H", 93, 98),
+    (["A92", "I92"], "I", "I", 93, 98),
+    (["K92"], "M", "P", 92, 98),
+    (["R92", "T92"], "T", "V", 93, 98),
+    (["R92", "W92"], "W", "AB", 93, 98),
+    (["R92"], "AC", "AC", 92, 98),
+]
+DATA_VALUES = {"C6": 2, "C7": 4, "C8": 8, "C9": 16, "C14": 1.5, "C15": 2.5}
+DATA_VALUES.update({"C16": 0, "C17": 1, "Y4": 0})
+NUM_EVENTS = 305  # data!AD29:LV29 (see LEFT_COLUMN and RIGHT_COLUMN)
+THREADS = 12  # rows 30 ... 41 of the data sheet
+
+
+def thread_formula(kind, e, f, row):
+    """A per-thread formula (of the kinds of cpu_pa_report.xlsm) over the
+    events of the data columns `e` and `f` in the data row `row`."""
+    x, y = f"data!{e}{row}", f"data!{f}{row}"
+    both = f'OR({x}="",{y}="")'
+    return [
+        f'=IF({x}="","",{x}/data!$C$4)',
+        f'=IF(data!$AC{row}=label!$B$3,IF({both},"",({x}+{y})*data!$C$6),'
+        "label!$B$2)",
+        f'=IF({both},"",GuardLimitUpper({x}/({y}+{x}),data!$Y$4,1))',
+        f'=IF({both},"",{x}-{y}*0.5)',
+        f'=IF({x}="","",{x}/SUM(data!{e}$30:{e}$41))',
+        f'=IF({x}="","",GuardLimitLower({x}/AVERAGE(data!{f}$30:{f}$41),'
+        "data!$C$16,2))",
+        f'=IF({both},"",({x}+{y})/(data!$C$4*data!$C$7)^2)',
+    ][kind]
+
+
+def write_workbook(path, events):
+    """A workbook with the layout of a loaded cpu_pa_report.xlsm: the
+    cells of `add_tables` in the "report" sheet, with per-thread columns
+    (some referencing the previous column), sums over the threads and
+    totals, and the event names and constants in the "data" sheet."""
+    workbook = openpyxl.Workbook()
+    report = workbook.active
+    report.title = "report"
+    data = workbook.create_sheet("data")
+    label = workbook.create_sheet("label")
+    label["B2"], label["B3"] = "n/a", "FAPP-cpupa"
+    data["C4"] = 100000000
+    for cell, value in DATA_VALUES.items():
+        data[cell] = value
+    data.cell(29, 29, "LABEL-FAPP-cpupa")
+    for idx, event in enumerate(events[:NUM_EVENTS]):
+        data.cell(29, 30 + idx, event)
+    report["C3"], report["C4"] = "=data!G5", "=data!C4*2"
+    report["J3"], report["J5"] = "=data!G10", "=data!G12"
+    report["Q3"], report["Q4"] = "=data!G11", "=data!C10/data!C7"
+    for key, _ in SINGLES:
+        report[key] = f"single {key}"
+
+    def event_column(idx):
+        return get_column_letter(30 + idx % (NUM_EVENTS - 5))
+
+    num = 0
+    for prefix, begin, end, header, first in TABLES:
+        for key in prefix:
+            report[key] = f"sec {key}"
+        first_col = column_index_from_string(begin)
+        for col_idx in range(first_col, column_index_from_string(end) + 1):
+            col, num = get_column_letter(col_idx), num + 1
+            report[f"{col}{header}"] = f"metric {col}{header}"
+            last = first + THREADS - 1
+            if num % 9 == 4:
+                # A value over all the threads, merged over the rows.
+                e = event_column(num)
+                report[f"{col}{first}"] = f"=SUM(data!{e}30:{e}41)/data!$C$4"
+                report.merge_cells(f"{col}{first}:{col}{last}")
+                continue
+            e, f = event_column(num * 7), event_column(num * 13 + 1)
+            for thread in range(THREADS):
+                row, data_row = first + thread, 30 + thread
+                formula = thread_formula(num % 7, e, f, data_row)
+                if num % 5 == 0 and col_idx > first_col and (num - 1) % 9 != 4:
+                    # Referencing the previous (unmerged) column.
+                    prev = f"{get_column_letter(col_idx - 1)}{row}"
+                    x = f"data!{e}{data_row}"
+                    formula = f'=IF(OR({prev}="",{x}=""),"",{prev}*2+{x}/data!$C$4)'
+                report[f"{col}{row}"] = formula
+            cells = f"{col}{first}:{col}{last}"
+            report[f"{col}{last + 1}"] = f'=IF(COUNT({cells})=0,"",SUM({cells}))'
+    workbook.save(path)
+
+
+def edit_workbook(path, edited_path):
+    """The workbook `path` with a few formulas and constants changed."""
+    workbook = openpyxl.load_workbook(path)
+    report, data = workbook["report"], workbook["data"]
+    report["C4"] = "=data!C4*3"
+    data["Y4"] = 1
+    for row in range(14, 26):
+        report[f"E{row}"] = report[f"E{row}"].value.replace("data!$C$4", "data!$C$7")
+    workbook.save(edited_path)
+
+
+class Transpiler:
+    """xls_parse.py in a copy of the repository (its programs are written
+    next to it)."""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        for file in TRANSPILER_FILES + [f.name for f in REPO.glob("fapp_*.py.in")]:
+            shutil.copy(REPO / file, workdir)
+
+    def run(self, xlsx, *options):
+        """The messages of a run and its module (with --backend, the
+        numpy or nan module)."""
+        cmd = [sys.executable, "xls_parse.py", str(xlsx), *options]
+        result = subprocess.run(
+            cmd, cwd=self.workdir, check=True, capture_output=True, text=True
+        )
+        match = re.search(r"Created (\S+)", result.stdout)
+        return result.stdout, (self.workdir / match.group(1)).read_bytes()
+
+    def evaluate(self, program, profile, *options):
+        cmd = [sys.executable, program, str(profile), *options]
+        result = subprocess.run(
+            cmd, cwd=self.workdir, check=True, capture_output=True, text=True
+        )
+        return json.loads(result.stdout)
+
+
+def check_incremental(transpiler, book, edited):
+    """A fresh and an incremental transpilation write the same module,
+    whatever the workbook of the previous run."""
+    failures = []
+    _, fresh = transpiler.run(book, "--rebuild")
+    messages, edited_incremental = transpiler.run(edited)
+    reused = re.search(r"Reused (\d+) of (\d+)", messages)
+    if not (reused and 0 < int(reused.group(1)) < int(reused.group(2))):
+        failures.append(f"the edited workbook didn't reuse some cells: {messages}")
+    _, incremental = transpiler.run(book)
+    if incremental != fresh:
+        failures.append("book -> edited -> book differs from a fresh transpile")
+    _, edited_fresh = transpiler.run(edited, "--rebuild")
+    if edited_incremental != edited_fresh:
+        failures.append("book -> edited differs from a fresh transpile of edited")
+    return failures
+
+
+def check_variants(transpiler, book, profile):
+    """The options changing the generated code give the same results."""
+    failures = []
+    variants = {
+        "--no-optimize": ("xls_parse.out.py", ["--no-optimize"]),
+        "--unroll-threads": ("xls_parse.out.py", ["--unroll-threads"]),
+        "--backend nan": ("xls_parse.nan.out.py", ["--backend", "nan"]),
+    }
+    selections = [["--roi", "kernel", "--cmg", "0"], ["--roi", "all", "--cmg", "1"]]
+    transpiler.run(book, "--rebuild")
+    expected = [
+        transpiler.evaluate("xls_parse.out.py", profile, *s) for s in selections
+    ]
+    for name, (program, options) in variants.items():
+        transpiler.run(book, "--rebuild", *options)
+        for selection, results in zip(selections, expected):
+            if transpiler.evaluate(program, profile, *selection) != results:
+                failures.append(f"{name} {' '.join(selection)}: different results")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--missing",
+        help="Probability of a counter being left out of the synthetic "
+        "profile (default: 0.02)",
+        type=float,
+        default=0.02,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        events = fapp_synth.default_events()
+        book, edited = workdir / "book.xlsx", workdir / "edited.xlsx"
+        write_workbook(book, events)
+        edit_workbook(book, edited)
+        profile = workdir / "profile"
+        fapp_synth.write_profile(
+            profile, events, args.seed, threads=THREADS, cmgs=2, missing=args.missing
+        )
+        transpiler = Transpiler(workdir)
+        failures["incremental"] = check_incremental(transpiler, book, edited)
+        failures["variants"] = check_variants(transpiler, book, profile)
+
+    for name, messages in failures.items():
+        print(f"{name}: {'FAILED' if messages else 'ok'}")
+        for message in messages:
+            print(f"  {message}")
+    sys.exit(1 if any(failures.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
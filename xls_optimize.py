@@ -0,0 +1,572 @@
+"""Optimizing passes over the lines emitted by xls_parse.py.
+
+Each line is either a cell assignment (``report_C14 = ...``) or an
+``add_path(...)`` call recording an output.  The lines are parsed into
+Python ASTs, which share their cell variables as the edges of the
+expression DAG, and rewritten by:
+
+- constant folding (and propagation of cells with constant values),
+- common subexpression elimination (into ``_cseN`` temporaries),
+- dead cell elimination (cells no ``add_path`` depends on).
+
+The programs of ``--backend nan`` (empty cells are NaN) are also
+rewritten before (`nan_conditions`) and after (`typed_outputs`) these.
+
+"""
+
+import ast
+import copy
+import hashlib
+import operator
+
+BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+    ast.Mod: operator.mod,
+}
+
+UNARY_OPS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+}
+
+COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# Names, other than cells, which may appear in a common subexpression.
+PURE_NAMES = {
+    "fapp_xml",
+    "EMPTY",
+    "NAN",
+    "any",
+    "len",
+    "xls_nonempty",
+    "xls_sum",
+    "xls_if",
+    "xls_or",
+    "xls_count",
+    "xls_average",
+    "xls_true",
+    "xls_column",
+    "vba_guard_limit_lower",
+    "vba_guard_limit_upper",
+}
+
+CSE_PREFIX = "_cse"
+
+
+def is_constant(node):
+    return isinstance(node, ast.Constant) and not isinstance(node.value, bytes)
+
+
+def assigned_name(stmt):
+    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+        target = stmt.targets[0]
+        if isinstance(target, ast.Name):
+            return target.id
+    return None
+
+
+def used_names(node):
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """Replace cells with known constant values and evaluate operators
+    whose operands are all constants.  Operations which fail (e.g.
+    division by zero) are left for the generated program."""
+
+    def __init__(self, constants):
+        self.constants = constants
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            return ast.Constant(self.constants[node.id])
+        return node
+
+    def fold(self, node, func, *args):
+        try:
+            value = func(*args)
+        except Exception:
+            return node
+        if isinstance(value, (bool, int, float, str)):
+            return ast.copy_location(ast.Constant(value), node)
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        op = BIN_OPS.get(type(node.op))
+        if op and is_constant(node.left) and is_constant(node.right):
+            left, right = node.left.value, node.right.value
+            # Don't compute huge powers at transpile time.
+            if op is operator.pow and abs(right) > 64:
+                return node
+            return self.fold(node, op, left, right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        op = UNARY_OPS.get(type(node.op))
+        if op and is_constant(node.operand):
+            return self.fold(node, op, node.operand.value)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        ops = [COMPARE_OPS.get(type(op)) for op in node.ops]
+        if all(ops) and all(is_constant(o) for o in operands):
+
+            def compare():
+                values = [o.value for o in operands]
+                pairs = zip(ops, values, values[1:])
+                return all(op(a, b) for op, a, b in pairs)
+
+            return self.fold(node, compare)
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        if is_constant(node.test):
+            return node.body if node.test.value else node.orelse
+        return node
+
+
+class Hoister(ast.NodeTransformer):
+    """Replace the common subexpressions of a statement by temporaries.
+
+    A temporary is defined right before the first statement which
+    evaluates the expression unconditionally (i.e. not in a branch of
+    an ``if`` expression or after the first operand of ``and``/``or``),
+    so no expression is evaluated where it wasn't before.
+
+    """
+
+    def __init__(self, keys, counts, available, new_stmts):
+        self.keys = keys
+        self.counts = counts
+        self.available = available
+        self.new_stmts = new_stmts
+        self.conditional = 0
+
+    def visit_IfExp(self, node):
+        node.test = self.visit(node.test)
+        self.conditional += 1
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+        self.conditional -= 1
+        return node
+
+    def visit_BoolOp(self, node):
+        node.values[0] = self.visit(node.values[0])
+        self.conditional += 1
+        node.values[1:] = [self.visit(v) for v in node.values[1:]]
+        self.conditional -= 1
+        return node
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Call, ast.BinOp)):
+            return super().generic_visit(node)
+        # The key is taken before the subexpressions are replaced.
+        key = self.keys[id(node)]
+        if key in self.available:
+            return ast.Name(self.available[key], ast.Load())
+        node = super().generic_visit(node)
+        if self.counts.get(key, 0) < 2 or self.conditional:
+            return node
+        name = f"{CSE_PREFIX}{len(self.available)}"
+        self.available[key] = name
+        target = ast.Name(name, ast.Store())
+        self.new_stmts.append(ast.Assign([target], node, lineno=0))
+        return ast.Name(name, ast.Load())
+
+
+def structural_keys(tree, table):
+    """Number the subtrees of `tree`, so that equal subtrees (as in
+    `ast.dump`) get the same number across the trees sharing `table`.
+    Unlike dumping every subtree, this is linear in the size of `tree`."""
+    keys = {}
+
+    def visit(node):
+        fields = [type(node).__name__]
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                fields.append(visit(value))
+            elif isinstance(value, list):
+                fields.append(
+                    tuple(visit(v) if isinstance(v, ast.AST) else v for v in value)
+                )
+            else:
+                # 1, 1.0 and True are different constants.
+                fields.append((type(value).__name__, value))
+        key = keys[id(node)] = table.setdefault(tuple(fields), len(table))
+        return key
+
+    visit(tree)
+    return keys
+
+
+def cse_candidates(tree, cells, keys):
+    """Keys of the subexpressions of `tree` which can be shared."""
+    result = []
+
+    def visit(node):
+        if isinstance(node, (ast.Lambda, ast.comprehension, ast.GeneratorExp)):
+            return False
+        pure = all([visit(child) for child in ast.iter_child_nodes(node)])
+        if isinstance(node, ast.Name):
+            pure = node.id in cells or node.id in PURE_NAMES
+        if pure and isinstance(node, (ast.Call, ast.BinOp)):
+            result.append(keys[id(node)])
+        return pure
+
+    visit(tree)
+    return result
+
+
+def fold_constants(stmts):
+    constants = {}
+    result = []
+    for stmt in stmts:
+        stmt = ConstantFolder(constants).visit(stmt)
+        name = assigned_name(stmt)
+        if name is not None and is_constant(stmt.value):
+            constants[name] = stmt.value.value
+        result.append(stmt)
+    return result
+
+
+def eliminate_common_subexpressions(stmts):
+    cells = {assigned_name(stmt) for stmt in stmts} - {None}
+    table = {}
+    keys = [structural_keys(stmt.value, table) for stmt in stmts]
+    counts = {}
+    for stmt, stmt_keys in zip(stmts, keys):
+        for key in cse_candidates(stmt.value, cells, stmt_keys):
+            counts[key] = counts.get(key, 0) + 1
+    available = {}
+    result = []
+    for stmt, stmt_keys in zip(stmts, keys):
+        new_stmts = []
+        hoister = Hoister(stmt_keys, counts, available, new_stmts)
+        stmt.value = hoister.visit(stmt.value)
+        result += new_stmts + [stmt]
+    return inline_single_use(result)
+
+
+def inline_single_use(stmts):
+    """Undo temporaries which ended up being used only once (e.g. the
+    subexpressions of a larger common subexpression)."""
+    uses = {}
+    for stmt in stmts:
+        for node in ast.walk(stmt.value):
+            if isinstance(node, ast.Name):
+                uses[node.id] = uses.get(node.id, 0) + 1
+    single = {}
+    result = []
+
+    class Inliner(ast.NodeTransformer):
+        def visit_Name(self, node):
+            return single.pop(node.id, node)
+
+    for stmt in stmts:
+        stmt.value = Inliner().visit(stmt.value)
+        name = assigned_name(stmt)
+        if name and name.startswith(CSE_PREFIX) and uses.get(name) == 1:
+            single[name] = stmt.value
+            continue
+        result.append(stmt)
+    return result
+
+
+def eliminate_dead_cells(stmts):
+    live = set()
+    result = []
+    for stmt in reversed(stmts):
+        name = assigned_name(stmt)
+        if name is not None and name not in live:
+            continue
+        live |= used_names(stmt)
+        result.append(stmt)
+    return result[::-1]
+
+
+def optimize(lines):
+    """Optimized version of the `lines` of the generated program."""
+    stmts = [ast.parse(line).body[0] for line in lines]
+    stmts = fold_constants(stmts)
+    stmts = eliminate_dead_cells(stmts)
+    stmts = eliminate_common_subexpressions(stmts)
+    stmts = eliminate_dead_cells(stmts)
+    return [ast.unparse(ast.fix_missing_locations(stmt)) for stmt in stmts]
+
+
+GET_EVENTS = ("get_event", "get_float_event")
+
+
+def is_get_event(node):
+    return (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr in GET_EVENTS
+        and node.args
+        and isinstance(node.args[0], ast.Constant)
+    )
+
+
+def is_add_path(stmt):
+    value = getattr(stmt, "value", None)
+    return (
+        isinstance(value, ast.Call)
+        and isinstance(value.func, ast.Name)
+        and value.func.id == "add_path"
+    )
+
+
+def add_path_key(stmt):
+    """The flattened key (see `flatten` of the generated program) of an
+    ``add_path``."""
+    path, key = [ast.literal_eval(arg) for arg in stmt.value.args[:2]]
+    return "::".join(str(k).strip() for k in path + [key])
+
+
+def output_events(lines):
+    """The events read (through `get_event`) by each ``add_path`` of
+    `lines`, keyed like the `flatten` of the generated program."""
+    cell_events = {}
+    result = {}
+    for line in lines:
+        stmt = ast.parse(line).body[0]
+        events = {n.args[0].value for n in ast.walk(stmt) if is_get_event(n)}
+        for name in used_names(stmt):
+            events |= cell_events.get(name, set())
+        name = assigned_name(stmt)
+        if name is not None:
+            cell_events[name] = events
+        elif is_add_path(stmt):
+            result[add_path_key(stmt)] = sorted(events)
+    return result
+
+
+def output_digests(lines):
+    """A digest of each ``add_path`` of `lines` (keyed like `output_events`)
+    and of the lines of the cells it (indirectly) reads, which changes
+    with any of these lines."""
+    digests = {}
+    result = {}
+    for line in lines:
+        stmt = ast.parse(line).body[0]
+        names = sorted(used_names(stmt) & digests.keys())
+        text = "\n".join([line] + [digests[name] for name in names])
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        name = assigned_name(stmt)
+        if name is not None:
+            digests[name] = digest
+        elif is_add_path(stmt):
+            result[add_path_key(stmt)] = digest
+    return result
+
+
+def is_nan(node):
+    return isinstance(node, ast.Name) and node.id == "NAN"
+
+
+def is_condition(node):
+    """Whether `node` evaluates to a bool."""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        return node.func.id in ("any", "xls_true")
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not)
+    return isinstance(node, (ast.Compare, ast.BoolOp)) or (
+        isinstance(node, ast.Constant) and isinstance(node.value, bool)
+    )
+
+
+class NanConditions(ast.NodeTransformer):
+    """Excel's ``x = ""`` (``x == NAN``) becomes ``x != x``, as NaN is the
+    only value unequal to itself, and the conditions of ``IF`` and ``OR``
+    which aren't comparisons go through ``xls_true`` (NaN is FALSE)."""
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) != 1 or not isinstance(node.ops[0], (ast.Eq, ast.NotEq)):
+            return node
+        left, right = node.left, node.comparators[0]
+        if is_nan(left) == is_nan(right):
+            return node
+        operand = right if is_nan(left) else left
+        op = ast.NotEq() if isinstance(node.ops[0], ast.Eq) else ast.Eq()
+        compare = ast.Compare(operand, [op], [copy.deepcopy(operand)])
+        return ast.copy_location(compare, node)
+
+    def truth(self, node):
+        if is_condition(node):
+            return node
+        return ast.Call(ast.Name("xls_true", ast.Load()), [node], [])
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        node.test = self.truth(node.test)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == "any":
+            if node.args and isinstance(node.args[0], ast.List):
+                node.args[0].elts = [self.truth(e) for e in node.args[0].elts]
+        return node
+
+
+def nan_conditions(lines):
+    """The `lines` of a NaN mode program with NaN-aware conditions."""
+    result = []
+    for line in lines:
+        stmt = NanConditions().visit(ast.parse(line).body[0])
+        result.append(ast.unparse(ast.fix_missing_locations(stmt)))
+    return result
+
+
+# Types of the values of the python backend, where counters are ints.
+INT_GETTERS = {
+    "get_vector_length",
+    "get_counter_timer_freq",
+    "get_process_no",
+    "get_cmg_no",
+}
+INT_FUNCS = {"xls_count", "len"}
+FLOAT_FUNCS = {
+    "xls_sum",
+    "xls_average",
+    "vba_guard_limit_lower",
+    "vba_guard_limit_upper",
+}
+BOOL_FUNCS = {"any", "xls_true", "xls_or"}
+NUMBERS = {"int", "bool"}
+
+
+def element_type(kind):
+    return kind[len("list:") :] if kind.startswith("list:") else "other"
+
+
+def merge_types(a, b):
+    """The type of a value which is either of type `a` or `b`."""
+    if a == b or b == "empty":
+        return a
+    if a == "empty":
+        return b
+    if {a, b} <= NUMBERS:
+        return "int"
+    if a.startswith("list:") and b.startswith("list:"):
+        return "list:" + merge_types(element_type(a), element_type(b))
+    if {a, b} <= NUMBERS | {"float"}:
+        return "float"
+    # A number or a text (e.g. "n/a"): only the number is converted.
+    for kind in (a, b):
+        if kind in ("int", "float"):
+            return kind
+    return "other"
+
+
+def value_type(node, types):
+    """The type ("int", "float", "bool", "str", "list:<type>", "empty" for
+    NAN, or "other") of `node` in the python backend, given the `types`
+    of the cells."""
+    if isinstance(node, ast.Constant):
+        kinds = {bool: "bool", int: "int", float: "float", str: "str"}
+        return kinds.get(type(node.value), "other")
+    if isinstance(node, ast.Name):
+        return "empty" if is_nan(node) else types.get(node.id, "other")
+    if isinstance(node, ast.BinOp):
+        left = value_type(node.left, types)
+        right = value_type(node.right, types)
+        if isinstance(node.op, ast.Div):
+            return "float"
+        if {left, right} <= NUMBERS:
+            # Negative powers of ints are floats.
+            if isinstance(node.op, ast.Pow) and not (
+                is_constant(node.right) and node.right.value >= 0
+            ):
+                return "float"
+            return "int"
+        return "float" if {left, right} <= NUMBERS | {"float"} else "other"
+    if isinstance(node, ast.UnaryOp):
+        return (
+            "bool" if isinstance(node.op, ast.Not) else value_type(node.operand, types)
+        )
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return "bool"
+    if isinstance(node, ast.IfExp):
+        return merge_types(value_type(node.body, types), value_type(node.orelse, types))
+    if isinstance(node, ast.Subscript):
+        return element_type(value_type(node.value, types))
+    if isinstance(node, ast.List):
+        kind = "empty"
+        for elt in node.elts:
+            elt_kind = value_type(elt, types)
+            if isinstance(elt, ast.Starred):
+                elt_kind = element_type(elt_kind)
+            kind = merge_types(kind, elt_kind)
+        return "list:" + kind
+    if isinstance(node, ast.Starred):
+        return value_type(node.value, types)
+    if isinstance(node, ast.ListComp):
+        inner = dict(types)
+        for generator in node.generators:
+            if isinstance(generator.target, ast.Name):
+                kind = element_type(value_type(generator.iter, inner))
+                inner[generator.target.id] = kind
+        return "list:" + value_type(node.elt, inner)
+    if is_get_event(node):
+        return "str" if node.args[0].value == "LABEL-FAPP-cpupa" else "int"
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return "int" if node.func.attr in INT_GETTERS else "other"
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        name = node.func.id
+        if name == "range":
+            return "list:int"
+        if name in INT_FUNCS:
+            return "int"
+        if name in FLOAT_FUNCS:
+            return "float"
+        if name in BOOL_FUNCS:
+            return "bool"
+    return "other"
+
+
+def typed_outputs(lines):
+    """The `lines` of a NaN mode program, with its outputs as in the python
+    backend: NaN becomes "" (`xls_value`), and the outputs which are ints
+    there (computed from the integer counters) ints (`xls_int`)."""
+    types = {}
+    result = []
+    for line in lines:
+        stmt = ast.parse(line).body[0]
+        name = assigned_name(stmt)
+        if name is not None:
+            types[name] = value_type(stmt.value, types)
+        elif is_add_path(stmt):
+            value = stmt.value.args[2]
+            kind = value_type(value, types)
+            if kind == "list:int":
+                func = "xls_ints"
+            elif kind.startswith("list:"):
+                func = None  # the NaN are filtered out (see add_column_of_12_1)
+            else:
+                func = "xls_int" if kind == "int" else "xls_value"
+            if func is not None:
+                call = ast.Call(ast.Name(func, ast.Load()), [value], [])
+                stmt.value.args[2] = call
+                line = ast.unparse(ast.fix_missing_locations(stmt))
+        result.append(line)
+    return result
@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 import argparse
+import hashlib
+import json
+import re
 import sys
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from pprint import pformat
 
 import openpyxl
-from openpyxl.cell.cell import Cell, MergedCell
 from openpyxl.formula import Tokenizer
 from openpyxl.formula.tokenizer import Token
+from openpyxl.utils.cell import (
+    column_index_from_string,
+    coordinate_from_string,
+    get_column_letter,
+    range_boundaries,
+)
+
+from fapp_loader import read_pa_xml
+from xls_optimize import (
+    nan_conditions,
+    optimize,
+    output_digests,
+    output_events,
+    typed_outputs,
+)
 
 
 def dbgp(msg):
@@ -15,13 +33,29 @@ def dbgp(msg):
     print(msg)
 
 
-WORKBOOK = None
-WORKBOOK_DATA = None
+WORKBOOK_PATH = None
+CELLS = {}  # "sheet!A1" -> value (formula or constant) of every cell
+DEFINED_NAMES = {}
+WORKBOOK_DATA = {}  # cached values of the sheets read by `cached_value`
+TRANSLATED = {}  # cell id -> (line, cells it reads), see `translate_cell`
+DEPENDENCIES = []  # cells read by the formula being parsed
+BACKEND = "python"
 LINES = []
 PROCESSED_CELLS = set()
 WORKSHEET_STACK = []
+SECTIONS = None  # the report sections to emit (all if None)
+CURRENT_SECTION = None
+THREAD_LOOPS = True  # see `thread_column`
+THREAD_COLUMNS = {}  # range id -> whether it's a per-thread column
+LOOP_CELL = None  # first cell of the per-thread column being translated
+INLINED = []  # cells whose values are part of the formula being parsed
+INPUTS = {}  # cell id -> the cells inlined in its line, see `translate_cell`
+RECORD = {}  # the cells of the previous run, see `load_record`
+UNCHANGED = {}  # cell id -> whether its record can be reused
 
 FAPP_XML_OBJ = "fapp_xml"
+THREAD_VAR = "thread_id"
+THREADS = f"range(len({FAPP_XML_OBJ}.cmg_tids))"
 SPECIAL_FAPP_XML_CALL = {
     "C4": f"{FAPP_XML_OBJ}.get_counter_timer_freq()",
     "G4": f"{FAPP_XML_OBJ}.get_measured_time()",
@@ -46,11 +80,24 @@ DATA_VALUES = {
     "Y4",
 }
 
+# Templates of the generated module around the formulas, and of its
+# command line wrapper (see --backend).
+BACKENDS = {
+    "python": ("fapp_top.py.in", "fapp_bottom.py.in", "fapp_cli.py.in"),
+    "numpy": (
+        "fapp_numpy_top.py.in",
+        "fapp_numpy_bottom.py.in",
+        "fapp_numpy_cli.py.in",
+    ),
+    "nan": ("fapp_nan_top.py.in", "fapp_bottom.py.in", "fapp_cli.py.in"),
+}
+
 HEADER_ROW = 29
 TOP_ROW = 30
 BOTOM_ROW = 41
 LEFT_COLUMN = 29
 RIGHT_COLUMN = 334
+NUM_THREADS = BOTOM_ROW - TOP_ROW + 1  # rows of the per-thread columns
 
 INFIX_OP_MAP = {
     "=": "==",
@@ -58,10 +105,56 @@ INFIX_OP_MAP = {
 }
 
 
+def read_worksheet(ws, cells):
+    # The dimensions stored in the file can't be trusted in read-only mode.
+    ws.reset_dimensions()
+    rows = ws.iter_rows(min_row=1, min_col=1, values_only=True)
+    for row, values in enumerate(rows, 1):
+        for col, value in enumerate(values, 1):
+            if value is not None:
+                cells[f"{ws.title}!{get_column_letter(col)}{row}"] = value
+
+
+def load_workbook(filename):
+    """Read the formulas of every sheet in a single streaming pass."""
+    global WORKBOOK_PATH
+    global DEFINED_NAMES
+    WORKBOOK_PATH = filename
+    workbook = openpyxl.load_workbook(filename, read_only=True)
+    DEFINED_NAMES = workbook.defined_names
+    for ws in workbook.worksheets:
+        read_worksheet(ws, CELLS)
+    workbook.close()
+
+
+def cached_value(ws, cell):
+    """The value of a cell as last computed by Excel."""
+    if ws not in WORKBOOK_DATA:
+        workbook = openpyxl.load_workbook(WORKBOOK_PATH, read_only=True, data_only=True)
+        WORKBOOK_DATA[ws] = {}
+        read_worksheet(workbook[ws], WORKBOOK_DATA[ws])
+        workbook.close()
+    return WORKBOOK_DATA[ws].get(f"{ws}!{cell}")
+
+
+@lru_cache(maxsize=None)
+def split_cell_id(cell_id):
+    """The sheet, column index and row of a full cell id."""
+    ws, cell = cell_id.replace("$", "").split("!")
+    col, row = coordinate_from_string(cell)
+    return ws, column_index_from_string(col), row
+
+
+def range_cell_ids(cell_id):
+    """The cells of (the first column of) a range, e.g. report!C14:C25."""
+    ws, cells = cell_id.replace("$", "").split("!")
+    min_col, min_row, _, max_row = range_boundaries(cells)
+    col = get_column_letter(min_col)
+    return [f"{ws}!{col}{row}" for row in range(min_row, max_row + 1)]
+
+
 def is_event_cell(cell_id):
-    cell = cell_id_to_obj(cell_id)
-    col = cell.col_idx
-    row = cell.row
+    _, col, row = split_cell_id(cell_id)
     result = (
         LEFT_COLUMN <= col
         and col <= RIGHT_COLUMN
@@ -72,43 +165,143 @@ def is_event_cell(cell_id):
 
 
 def full_cell_id(cell_id):
-    dbgp(f"> full_cell_id({cell_id})")
     prefix = WORKSHEET_STACK[-1] if WORKSHEET_STACK else "report"
-    if cell_id in WORKBOOK.defined_names:
-        cell_id = WORKBOOK.defined_names[cell_id].value
+    return _full_cell_id(prefix, cell_id)
+
+
+@lru_cache(maxsize=None)
+def _full_cell_id(prefix, cell_id):
+    dbgp(f"> full_cell_id({cell_id})")
+    if cell_id in DEFINED_NAMES:
+        cell_id = DEFINED_NAMES[cell_id].value
     elif "!" not in cell_id:
         cell_id = f"{prefix}!{cell_id}"
     dbgp(f"< full_cell_id -> {cell_id}")
     return cell_id
 
 
-def cell_obj_to_id(cell):
-    return cell.parent.title + "!" + cell.coordinate
-
-
 def cell_id_to_varname(cell_id):
     dbgp(f"> cell_id_to_varname({cell_id})")
+    cell_id = full_cell_id(cell_id)
     if ":" in cell_id:
-        cells = cell_id_to_obj(cell_id)
-        cell_ids = [cell_obj_to_id(cell[0]) for cell in cells]
-        cell_vars = [cell_id_to_varname(cell_id) for cell_id in cell_ids]
+        cell_vars = [cell_id_to_varname(c) for c in range_cell_ids(cell_id)]
         result = f"{', '.join(cell_vars)}"
     else:
-        cell_id = full_cell_id(cell_id)
         result = cell_id.replace("!", "_").replace("$", "")
     dbgp(f"< cell_id_to_varname -> {result}")
     return result
 
 
-def cell_id_to_obj(cell_id):
-    dbgp(f"> cell_id_to_obj({cell_id})")
-    cell_id = full_cell_id(cell_id)
-    ws, cell = cell_id.split("!")
-    cell = WORKBOOK[ws][cell]
-    if isinstance(cell, MergedCell):
-        print("WARNING: MergedCell!")
-    dbgp(f"< cell_id_to_obj -> {cell}")
-    return cell
+def column_varname(column):
+    """The variable of a per-thread column, e.g. report_C14_C25."""
+    ws, cells = column.split("!")
+    return f"{ws}_{cells.replace(':', '_')}"
+
+
+def inst_varname(cell_id):
+    return column_varname(cell_id) if ":" in cell_id else cell_id_to_varname(cell_id)
+
+
+def relative_ref(ref, row):
+    """(column, absolute row?, row) of a reference, with relative rows
+    as offsets from `row` (like R1C1), or None if it isn't a cell."""
+    match = re.fullmatch(r"(\$?[A-Z]+)(\$?)(\d+)", ref)
+    if match is None:
+        return None
+    col, absolute, ref_row = match.groups()
+    return col, bool(absolute), int(ref_row) if absolute else int(ref_row) - row
+
+
+def relative_formula(cell_id):
+    """The tokens of the formula of a cell, with the rows of its
+    references made relative to the cell."""
+    value = CELLS.get(cell_id)
+    if not (isinstance(value, str) and value.startswith("=")):
+        return None
+    ws, _, row = split_cell_id(cell_id)
+    result = []
+    for token in Tokenizer(value).items:
+        value = token.value
+        if token.subtype == Token.RANGE:
+            ref_ws, cells = _full_cell_id(ws, value).split("!")
+            value = ref_ws, tuple(relative_ref(c, row) for c in cells.split(":"))
+        result.append((token.type, token.subtype, value))
+    return result
+
+
+def is_thread_column(column):
+    ws, cells = column.split("!")
+    min_col, min_row, max_col, max_row = range_boundaries(cells)
+    if min_col != max_col or max_row - min_row != NUM_THREADS - 1:
+        return False
+    if ws == "data":
+        return min_row == TOP_ROW and is_event_cell(f"data!{cells.split(':')[0]}")
+    if ws != "report":
+        return False
+    cell_ids = range_cell_ids(column)
+    formulas = [relative_formula(cell_id) for cell_id in cell_ids]
+    if formulas[0] is None or any(f != formulas[0] for f in formulas):
+        return False
+    # Relative references must be to the cell of the same thread.
+    for _, subtype, value in formulas[0]:
+        if subtype != Token.RANGE:
+            continue
+        ref_ws, refs = value
+        if None in refs:
+            return False
+        relative = [ref for ref in refs if not ref[1]]
+        if not relative:
+            continue
+        if len(refs) > 1:
+            return False
+        col, _, offset = refs[0]
+        row = min_row + offset
+        if row < 1 or not thread_column(
+            f"{ref_ws}!{col}{row}:{col}{row + NUM_THREADS - 1}"
+        ):
+            return False
+    return True
+
+
+def thread_column(cell_id):
+    """The (canonical) id of the per-thread column of the range `cell_id`,
+    or None.  Per-thread columns are computed by a single loop over
+    the threads of the profile (instead of one line per row of the
+    workbook): the counters of an event (e.g. data!AD30:AD41), and
+    the report columns (e.g. report!C14:C25) whose formulas only
+    differ by the rows of their relative references, which are to
+    the same thread of other per-thread columns."""
+    column = cell_id.replace("$", "")
+    if not THREAD_LOOPS:
+        return None
+    if column not in THREAD_COLUMNS:
+        # Columns in circular references aren't per-thread columns.
+        THREAD_COLUMNS[column] = False
+        # Only per-thread columns are recorded.
+        THREAD_COLUMNS[column] = is_unchanged(column) or is_thread_column(column)
+    return column if THREAD_COLUMNS[column] else None
+
+
+def thread_operand(cell_id):
+    """The code of a whole per-thread column (e.g. the range of a SUM)
+    or, in the loop of a per-thread column, of the cell of the same
+    thread of another one.  None for other references."""
+    if ":" in cell_id:
+        column = thread_column(cell_id)
+        if column is None:
+            return None
+        DEPENDENCIES.append(column)
+        return f"*{column_varname(column)}"
+    ref = relative_ref(cell_id.split("!")[1], 0)
+    if LOOP_CELL is None or ref is None or ref[1]:
+        return None
+    # The loop is translated from the cell of the first thread.
+    col, _, row = ref
+    last = f"{col.lstrip('$')}{row + NUM_THREADS - 1}"
+    column = thread_column(f"{cell_id}:{last}")
+    assert column, f"{cell_id} isn't in a per-thread column (see is_thread_column)"
+    DEPENDENCIES.append(column)
+    return f"{column_varname(column)}[{THREAD_VAR}]"
 
 
 def unknown_type_exception(token):
@@ -135,49 +328,66 @@ def assert_func_close(token):
     assert token.type == Token.FUNC and token.subtype == Token.CLOSE
 
 
+@lru_cache(maxsize=None)
 def python_cmd_to_read_xml(cell_id):
+    # Only called with full cell ids, so the result can be cached.
     dbgp(f"> python_cmd_to_read_xml({cell_id})")
     result = None
     cell_id = cell_id.replace("$", "")
     if ":" in cell_id:
-        cells = cell_id_to_obj(cell_id)
-        cell_ids = [cell_obj_to_id(cell[0]) for cell in cells]
+        cell_ids = range_cell_ids(cell_id)
         results = [python_cmd_to_read_xml(cell_id) for cell_id in cell_ids]
         if any(results):
             result = f"{', '.join(results)}"
     else:
-        cell_id = full_cell_id(cell_id)
         ws, cell = cell_id.split("!")
         if ws == "label":
-            value = WORKBOOK[ws][cell].value
+            value = CELLS.get(cell_id)
             result = f"'{value}'"
         elif ws == "data":
             if cell in SPECIAL_FAPP_XML_CALL:
                 result = SPECIAL_FAPP_XML_CALL[cell]
             elif cell in DATA_VALUES:
-                result = str(WORKBOOK["data"][cell].value)
+                result = str(CELLS.get(cell_id))
             elif is_event_cell(cell_id):
-                cell_obj = WORKBOOK[ws][cell]
-                col = cell_obj.col_idx - 1
-                event_name = WORKBOOK[ws][HEADER_ROW][col].value
-                thread_id = cell_obj.row - HEADER_ROW - 1
-                result = f"{FAPP_XML_OBJ}.get_event('{event_name}', {thread_id})"
+                _, _, row = split_cell_id(cell_id)
+                result = get_event_cmd(cell_id, row - HEADER_ROW - 1)
     dbgp(f"< python_cmd_to_read_xml -> {result}")
     return result
 
 
+def event_getter():
+    """The method of FappXml the formulas read the counters with."""
+    return "get_float_event" if BACKEND == "nan" else "get_event"
+
+
+def get_event_cmd(cell_id, thread_id):
+    _, col, _ = split_cell_id(cell_id)
+    event_name = CELLS.get(f"data!{get_column_letter(col)}{HEADER_ROW}")
+    return f"{FAPP_XML_OBJ}.{event_getter()}('{event_name}', {thread_id})"
+
+
 def parse_operand(token):
     dbgp(f"> parse_operand({token})")
     if token.subtype == Token.RANGE:
         cell_id = full_cell_id(token.value)
-        raw = python_cmd_to_read_xml(cell_id)
+        raw = thread_operand(cell_id)
+        if not raw:
+            raw = python_cmd_to_read_xml(cell_id)
+            if raw:
+                INLINED.append(cell_id.replace("$", ""))
         if raw:
             result = raw
         else:
-            cell_to_inst(cell_id)
+            # Emitted by `cell_to_inst` before the cell reading it.
+            DEPENDENCIES.append(cell_id)
             result = cell_id_to_varname(cell_id)
     elif token.subtype == Token.TEXT:
         result = token.value
+        if BACKEND == "numpy" and result == '""':
+            result = "EMPTY"
+        elif BACKEND == "nan" and result == '""':
+            result = "NAN"
     elif token.subtype == Token.NUMBER:
         result = token.value
     else:
@@ -193,7 +403,10 @@ def parse_if(tokens, cur):
     assert_sep_comma(tokens[cur])
     false_val, cur = parse_tokens(tokens, cur + 1)
     assert_func_close(tokens[cur])
-    result = f"({true_val}) if ({cond}) else ({false_val})"
+    if BACKEND == "numpy":
+        result = f"xls_if({cond}, {true_val}, {false_val})"
+    else:
+        result = f"({true_val}) if ({cond}) else ({false_val})"
     return result, cur
 
 
@@ -204,14 +417,20 @@ def parse_or(tokens, cur):
         if tmp != "":
             ops += f", {tmp}"
     assert_func_close(tokens[cur])
-    result = f"any([{ops}])"
+    if BACKEND == "numpy":
+        result = f"xls_or([{ops}])"
+    else:
+        result = f"any([{ops}])"
     return result, cur
 
 
 def parse_count(tokens, cur):
     cells, cur = parse_tokens(tokens, cur + 1)
     assert_func_close(tokens[cur])
-    result = f"sum(1 for e in [{cells}] if e !='')"
+    if BACKEND in ("numpy", "nan"):
+        result = f"xls_count([{cells}])"
+    else:
+        result = f"sum(1 for e in [{cells}] if e !='')"
     return result, cur
 
 
@@ -229,7 +448,10 @@ def parse_average(tokens, cur):
         if tmp != "":
             terms += f", {tmp}"
     assert_func_close(tokens[cur])
-    result = f"(xls_sum([{terms}]) / len(xls_nonempty([{terms}])))"
+    if BACKEND in ("numpy", "nan"):
+        result = f"xls_average([{terms}])"
+    else:
+        result = f"(xls_sum([{terms}]) / len(xls_nonempty([{terms}])))"
     return result, cur
 
 
@@ -315,48 +537,286 @@ def parse_tokens(tokens, cur):
     return result, cur
 
 
-def cell_to_inst(cell_id):
-    dbgp(f"> cell_to_inst({cell_id})")
-    cell_id = full_cell_id(cell_id)
-    cell = cell_id_to_obj(cell_id)
-    if isinstance(cell, tuple):
-        for c in cell:
-            cell_to_inst(cell_obj_to_id(c[0]))
+def translate_cell(cell_id):
+    """The line computing a cell, or a per-thread column (see
+    `thread_column`), and the cells it reads (each cell is tokenized
+    and parsed only once)."""
+    global LOOP_CELL
+    if cell_id in TRANSLATED:
+        return TRANSLATED[cell_id]
+    if is_unchanged(cell_id):
+        record = RECORD["cells"][cell_id]
+        INPUTS[cell_id] = list(record["inputs"])
+        TRANSLATED[cell_id] = record["line"], record["deps"]
+        return TRANSLATED[cell_id]
+    ws = cell_id.split("!")[0]
+    first = range_cell_ids(cell_id)[0] if ":" in cell_id else cell_id
+    DEPENDENCIES.clear()
+    INLINED.clear()
+    if ws == "data" and ":" in cell_id:
+        # The counters of an event.
+        cell_val = get_event_cmd(first, THREAD_VAR)
     else:
-        cell_var = cell_id_to_varname(cell_id)
-        if cell_var in PROCESSED_CELLS:
-            return
-        WORKSHEET_STACK.append(cell.parent.title)
-        tokens = Tokenizer(cell.value).items
+        value = CELLS.get(first)
+        if value is None:
+            raise Exception(f"ERROR: Empty (or merged) cell {cell_id}")
+        WORKSHEET_STACK.append(ws)
+        if ":" in cell_id:
+            # The formula of the first thread, with `thread_operand`s.
+            LOOP_CELL = first
+        tokens = Tokenizer(value).items
         cell_val, _ = parse_tokens(tokens, 0)
+        LOOP_CELL = None
         WORKSHEET_STACK.pop()
-        line = f"{cell_var} = {cell_val}"
+    cell_ids = []
+    for dep in DEPENDENCIES:
+        dep = dep.replace("$", "")
+        if ":" in dep and not THREAD_COLUMNS.get(dep):
+            cell_ids += range_cell_ids(dep)
+        else:
+            cell_ids.append(dep)
+    if ":" in cell_id:
+        cell_val = f"[{cell_val} for {THREAD_VAR} in {THREADS}]"
+    INPUTS[cell_id] = list(dict.fromkeys(INLINED))
+    TRANSLATED[cell_id] = f"{inst_varname(cell_id)} = {cell_val}", cell_ids
+    return TRANSLATED[cell_id]
+
+
+def cell_source(cell_id):
+    """What the line of a cell (or of a per-thread column) is translated
+    from: its formula, or the event name of a counter."""
+    if ":" in cell_id:
+        return repr([cell_source(c) for c in range_cell_ids(cell_id)])
+    ws, col, _ = split_cell_id(cell_id)
+    if ws == "data" and is_event_cell(cell_id):
+        return repr(CELLS.get(f"data!{get_column_letter(col)}{HEADER_ROW}"))
+    return repr(CELLS.get(cell_id.replace("$", "")))
+
+
+def is_unchanged(cell_id):
+    """Whether the recorded line of a cell can be reused: the formulas of
+    the cell, of the cells it (indirectly) reads and of the values it
+    inlines are those of the previous run."""
+    cells = RECORD.get("cells", {})
+    stack = [cell_id]
+    visited = set()  # cells whose dependencies are on the stack
+    while stack:
+        top = stack[-1]
+        if top in UNCHANGED:
+            stack.pop()
+            continue
+        record = cells.get(top)
+        if record is None or record["source"] != cell_source(top):
+            UNCHANGED[top] = False
+            stack.pop()
+            continue
+        deps = [d for d in record["deps"] if d not in UNCHANGED]
+        if deps and top not in visited:
+            visited.add(top)
+            stack += deps
+            continue
+        inputs = record["inputs"].items()
+        UNCHANGED[top] = all(UNCHANGED.get(d) for d in record["deps"]) and all(
+            cell_source(i) == source for i, source in inputs
+        )
+        stack.pop()
+    return UNCHANGED[cell_id]
+
+
+def cell_to_inst(cell_id):
+    """Emit the line of a cell (or of a per-thread column), after the
+    lines of the cells it reads.
+
+    The dependencies are walked with an explicit stack (in the same
+    depth-first order as a recursive descent), so long chains of
+    formulas don't hit the recursion limit.
+
+    """
+    dbgp(f"> cell_to_inst({cell_id})")
+    cell_id = full_cell_id(cell_id).replace("$", "")
+    stack = [cell_id]
+    if ":" in cell_id and not thread_column(cell_id):
+        stack = range_cell_ids(cell_id)[::-1]
+    pending = set()  # cells waiting for their dependencies
+    while stack:
+        cell_id = stack.pop()
+        cell_var = inst_varname(cell_id)
+        if cell_var in PROCESSED_CELLS:
+            continue
+        line, deps = translate_cell(cell_id)
+        deps = [d for d in deps if inst_varname(d) not in PROCESSED_CELLS]
+        if deps:
+            if cell_id in pending:
+                raise Exception(f"ERROR: Circular reference in {cell_id}")
+            pending.add(cell_id)
+            stack.append(cell_id)
+            stack += deps[::-1]
+            continue
         PROCESSED_CELLS.add(cell_var)
         LINES.append(line)
         dbgp(f"< cell_to_inst -> APPEND: {line}")
 
 
-def get_label(cell_id):
-    cell = WORKBOOK_DATA["report"][cell_id]
-    return cell.value
+def get_label(cell_id, ws="report"):
+    """The value of a (header) cell as shown by Excel.  References to
+    other cells are followed, and only other formulas fall back to the
+    values cached in the workbook."""
+    value = CELLS.get(f"{ws}!{cell_id}")
+    if not (isinstance(value, str) and value.startswith("=")):
+        return value
+    tokens = Tokenizer(value).items
+    if len(tokens) == 1 and tokens[0].subtype == Token.RANGE:
+        ref = _full_cell_id(ws, tokens[0].value)
+        if ":" not in ref:
+            ref_ws, ref_cell = ref.replace("$", "").split("!")
+            return get_label(ref_cell, ref_ws)
+    return cached_value(ws, cell_id)
+
+
+def event_manifest(sample_dir=None):
+    """Lines of the generated program with the events read by each output
+    and, if a sample profile is given, the paN.xml file of each event."""
+    metric_events = output_events(LINES)
+    events = set().union(*metric_events.values())
+    event_files = {}
+    for idx in range(1, 18) if sample_dir else []:
+        xml = read_pa_xml(Path(sample_dir).expanduser() / f"pa{idx}.xml")
+        for region in xml["regions"].values():
+            for name in events.intersection(region["events"]):
+                event_files.setdefault(name, idx)
+    return [
+        "# paN.xml (N) of each event, from the profile given to xls_parse.py\n",
+        "# by --sample-xml-dir (see `needed_files`).\n",
+        f"EVENT_FILES = {pformat(event_files)}\n",
+        "\n",
+        "# Events read by each output (flattened key, see `flatten`).\n",
+        f"METRIC_EVENTS = {pformat(metric_events, sort_dicts=False)}\n",
+        "\n",
+        "# The method of FappXml reading the events (counted by --profile).\n",
+        f"EVENT_GETTER = {event_getter()!r}\n",
+    ]
+
+
+def record_options(optimize=True):
+    """What the recorded lines depend on, besides the formulas."""
+    names = sorted((name, str(d.value)) for name, d in DEFINED_NAMES.items())
+    transpiler = hashlib.sha256()
+    for name in ["xls_parse.py", "xls_optimize.py"]:
+        transpiler.update((Path(__file__).parent / name).read_bytes())
+    return {
+        "transpiler": transpiler.hexdigest(),
+        "defined_names": hashlib.sha256(repr(names).encode()).hexdigest(),
+        "backend": BACKEND,
+        "thread_loops": THREAD_LOOPS,
+        "optimize": optimize,
+    }
+
+
+def load_record(path, options):
+    """Read the record of the previous run (see `save_record`).  Only the
+    digests of its outputs are kept if it was made with other options."""
+    global RECORD
+    try:
+        with open(path) as file:
+            record = json.load(file)
+    except FileNotFoundError:
+        return
+    if record.get("options") == options:
+        RECORD = record
+    else:
+        RECORD = {"outputs": record.get("outputs", {})}
+
+
+def save_record(path, options, outputs, lines_digest):
+    """Record the formula, the line, the dependencies and the inlined
+    cells of every translated cell, the digest of every output and the
+    final lines of the program, for the next run."""
+    # Runs with --sections only add to the record.
+    cells = RECORD.get("cells", {}) if SECTIONS else {}
+    for cell_id, (line, deps) in TRANSLATED.items():
+        cells[cell_id] = {
+            "source": cell_source(cell_id),
+            "line": line,
+            "deps": deps,
+            "inputs": {i: cell_source(i) for i in INPUTS[cell_id]},
+        }
+    if SECTIONS:
+        outputs = dict(RECORD.get("outputs", {}), **outputs)
+    record = {
+        "options": options,
+        "cells": cells,
+        "outputs": outputs,
+        "lines": lines_digest,
+        "program": LINES,
+    }
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as file:
+        json.dump(record, file)
+    tmp.replace(path)
+
+
+def report_changes(outputs):
+    """Print how many cells were reused from the record of the previous
+    run, and the metrics (flattened keys) whose formulas changed since."""
+    old = RECORD.get("outputs")
+    reused = sum(bool(UNCHANGED.get(cell_id)) for cell_id in TRANSLATED)
+    print(f"Reused {reused} of {len(TRANSLATED)} translated cells")
+    if old is None:
+        print("No record of a previous run to compare the metrics with")
+        return
+    changes = {
+        "changed": [k for k in outputs if k in old and old[k] != outputs[k]],
+        "added": [k for k in outputs if k not in old],
+        # Runs with --sections don't have every metric.
+        "removed": [] if SECTIONS else [k for k in old if k not in outputs],
+    }
+    print(", ".join(f"{len(keys)} metrics {kind}" for kind, keys in changes.items()))
+    for kind, keys in changes.items():
+        for key in keys:
+            print(f"  {kind}: {key}")
 
 
-def create_program(output):
+def create_program(output, cli_output, sample_dir=None):
+    """Write the module with `compute(fapp_xml)` to `output` and the
+    command line program importing it to `cli_output`."""
+    top_file, bottom_file, cli_file = BACKENDS[BACKEND]
     result = []
     with open("fapp_loader.py") as loader:
         result += loader.readlines()
+    loader_end = len(result)
+    result += ["\n", "\n"] + event_manifest(sample_dir)
+
+    with open("fapp_output.py.in") as out:
+        result += ["\n", "\n"] + out.readlines()
 
-    with open("fapp_top.py.in") as top:
-        result += top.readlines()
+    with open(top_file) as top:
+        result += ["\n", "\n"] + top.readlines()
 
-    result += [line + "\n" for line in LINES]
+    # The formulas are the body of `compute` (see fapp_top.py.in).
+    result += ["    " + line + "\n" for line in LINES]
 
-    with open("fapp_bottom.py.in") as top:
-        result += top.readlines()
+    with open(bottom_file) as bottom:
+        result += bottom.readlines()
+
+    # Part of the result cache keys of the generated program.
+    fingerprint = hashlib.sha256("".join(result).encode()).hexdigest()
+    result.insert(loader_end, f'\n\nPROGRAM_FINGERPRINT = "{fingerprint}"\n')
 
     result = "".join(result)
     with open(output, "w") as out:
         out.write(result)
+
+    # The module is found next to the wrapper (the first entry of sys.path).
+    with open(cli_file) as cli:
+        cli_program = [
+            "#!/usr/bin/env python\n",
+            f'"""Command line interface of {output.name}."""\n',
+            f"from {output.stem} import *\n",
+            "\n",
+            "\n",
+        ] + cli.readlines()
+    with open(cli_output, "w") as out:
+        out.write("".join(cli_program))
     return result
 
 
@@ -366,28 +826,56 @@ def record_entry(prefix, key, value):
     )
 
 
+def begin_section(name):
+    global CURRENT_SECTION
+    CURRENT_SECTION = name
+    if section_selected():
+        # Marks the sections of the report for `--profile` (see Profiler).
+        LINES.append(f"profiler.section({name!r})")
+
+
+def section_selected():
+    return SECTIONS is None or CURRENT_SECTION in SECTIONS
+
+
 def add_key_single_value_pair(prefix, key, value):
+    if not section_selected():
+        return
     cell_to_inst(value)
     record_entry(prefix, get_label(key), cell_id_to_varname(value))
 
 
 def add_column_of_12_1(prefix, key, first, num_rows=12):
-    first_cell = cell_id_to_obj(first)
-    row = first_cell.row
-    col = first_cell.col_idx - 1
-    if isinstance(WORKBOOK["report"][row + 1][col], MergedCell):
+    if not section_selected():
+        return
+    _, col, row = split_cell_id(full_cell_id(first))
+    col = get_column_letter(col)
+    # Merged cells (a single value for every thread) read as empty.
+    if f"report!{col}{row + 1}" not in CELLS:
         add_key_single_value_pair(prefix, key, first)
     else:
-        cell_varnames = []
-        for offset in range(num_rows):
-            cell_id = cell_obj_to_id(WORKBOOK["report"][row + offset][col])
-            cell_to_inst(cell_id)
-            cell_varnames.append(cell_id_to_varname(cell_id))
-
-        total_id = cell_obj_to_id(WORKBOOK["report"][row + num_rows][col])
+        column = thread_column(f"report!{col}{row}:{col}{row + num_rows - 1}")
+        if column:
+            # A single loop over the threads of the profile.
+            cell_to_inst(column)
+            cells = column_varname(column)
+        else:
+            cell_varnames = []
+            for offset in range(num_rows):
+                cell_id = f"report!{col}{row + offset}"
+                cell_to_inst(cell_id)
+                cell_varnames.append(cell_id_to_varname(cell_id))
+            cells = f"[{', '.join(cell_varnames)}]"
+
+        total_id = f"report!{col}{row + num_rows}"
         cell_to_inst(total_id)
 
-        value = f"[e for e in [{', '.join(cell_varnames)}] if e != '']"
+        if BACKEND == "numpy":
+            value = f"xls_column({cells})"
+        elif BACKEND == "nan":
+            value = f"[e for e in {cells} if e == e]"
+        else:
+            value = f"[e for e in {cells} if e != '']"
         label = get_label(key)
         record_entry(prefix, label, value)
         # total_var = cell_id_to_varname(total_id)
@@ -428,7 +916,7 @@ def add_table(prefix, begin_col, end_col, head_row, first_row):
 
 
 def add_tables():
-    # TOP
+    begin_section("TOP")
     add_key_single_value_pair([], "A3", "C3")
     add_key_single_value_pair([], "A4", "C4")
     add_key_single_value_pair([], "H3", "J3")
@@ -437,10 +925,10 @@ def add_tables():
     add_key_single_value_pair([], "O3", "Q3")
     add_key_single_value_pair([], "O4", "Q4")
 
-    # STATISTICS
+    begin_section("STATISTICS")
     add_table(["A8"], "C", "N", 8, 14)
 
-    # CYCLE ACCOUNTING
+    begin_section("CYCLE ACCOUNTING")
     add_table(["P8", "R8"], "R", "S", 9, 14)
     add_table(["P8", "T8"], "T", "Y", 9, 14)
     add_table(["P8", "Z8"], "Z", "AA", 9, 14)
@@ -449,13 +937,13 @@ def add_tables():
     add_table(["P8", "AH8"], "AH", "AK", 9, 14)
     add_table(["P8"], "AL", "AL", 8, 14)
 
-    # BUSY
+    begin_section("BUSY")
     add_table(["A28"], "C", "P", 28, 34)
 
-    # CACHE
+    begin_section("CACHE")
     add_table(["A48"], "C", "P", 48, 55)
 
-    # INSTRUCTIONS
+    begin_section("INSTRUCTIONS")
     add_table(["A69", "C69", "C70", "C71"], "C", "I", 72, 77)
     add_table(["A69", "C69", "C70", "J71"], "J", "J", 72, 77)
     add_table(["A69", "C69", "K70", "K71"], "K", "O", 72, 77)
@@ -466,18 +954,18 @@ def add_tables():
     add_table(["A69", "X69"], "X", "Y", 71, 77)
     add_table(["A69"], "Z", "AE", 69, 77)
 
-    # POWER
+    begin_section("POWER")
     add_table(["AG69"], "AI", "AK", 69, 77)
 
-    # PREFETCH
+    begin_section("PREFETCH")
     add_table(["A92", "C92"], "C", "E", 93, 98)
     add_table(["A92", "F92"], "F", "H", 93, 98)
     add_table(["A92", "I92"], "I", "I", 93, 98)
 
-    # FLOP
+    begin_section("FLOP")
     add_table(["K92"], "M", "P", 92, 98)
 
-    # EXTRA
+    begin_section("EXTRA")
     add_table(["R92", "T92"], "T", "V", 93, 98)
     add_table(["R92", "W92"], "W", "AB", 93, 98)
     add_table(["R92"], "AC", "AC", 92, 98)
@@ -489,8 +977,9 @@ def add_tables():
 
 
 def main():
-    global WORKBOOK
-    global WORKBOOK_DATA
+    global BACKEND
+    global SECTIONS
+    global THREAD_LOOPS
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -498,17 +987,86 @@ def main():
         type=str,
         help="Path to the input xls file",
     )
+    parser.add_argument(
+        "--backend",
+        help="python: one profile per run, "
+        "numpy: vectorized over a batch of profiles, "
+        "nan: like python, with float counters and NaN for empty cells "
+        "(default: python)",
+        choices=BACKENDS.keys(),
+        default="python",
+    )
+    parser.add_argument(
+        "--no-optimize",
+        help="Emit the formulas as they are, without the optimizing passes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--unroll-threads",
+        help="Emit one line per thread of the workbook for each per-thread "
+        "column, instead of a loop over the threads of the profile",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sections",
+        help="Comma separated report sections to emit, e.g. STATISTICS,FLOP "
+        "(default: all, see add_tables)",
+    )
+    parser.add_argument(
+        "--record",
+        help="Record of the cells of the previous run, whose lines are reused "
+        "if their formulas didn't change (default: the module + .cells.json)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        help="Translate every cell again, ignoring the --record",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sample-xml-dir",
+        help="Directory of paN.xml files from which the file of each event is "
+        "taken, so the generated program reads only the files it needs",
+    )
     args = parser.parse_args()
+    BACKEND = args.backend
+    THREAD_LOOPS = not args.unroll_threads
+    if args.sections is not None:
+        SECTIONS = args.sections.split(",")
     filename = Path(args.input_xls).expanduser()
 
-    WORKBOOK = openpyxl.load_workbook(filename)
-    WORKBOOK_DATA = openpyxl.load_workbook(filename, data_only=True)
+    # e.g. xls_parse_out.py (importable) and xls_parse.out.py (CLI)
+    infix = "" if BACKEND == "python" else f"_{BACKEND}"
+    module_file = sys.argv[0].replace(".py", f"{infix}_out.py")
+    out_file = sys.argv[0].replace(".py", f"{infix.replace('_', '.')}.out.py")
+    record_file = Path(args.record or module_file.replace(".py", ".cells.json"))
 
-    add_tables()
+    load_workbook(filename)
+    options = record_options(not args.no_optimize)
+    # With --rebuild, only the metrics are compared with the record.
+    load_record(record_file.expanduser(), None if args.rebuild else options)
 
-    out_file = sys.argv[0].replace(".py", ".out.py")
-    create_program(Path(out_file).expanduser())
-    print(f"Created {out_file}")
+    add_tables()
+    outputs = output_digests(LINES)
+    lines_digest = hashlib.sha256("\n".join(LINES).encode()).hexdigest()
+    if RECORD.get("lines") == lines_digest:
+        # The same lines as in the previous run.
+        LINES[:] = RECORD["program"]
+    else:
+        if BACKEND == "nan":
+            LINES[:] = nan_conditions(LINES)
+        if not args.no_optimize:
+            LINES[:] = optimize(LINES)
+        if BACKEND == "nan":
+            LINES[:] = typed_outputs(LINES)
+
+    create_program(
+        Path(module_file).expanduser(),
+        Path(out_file).expanduser(),
+        args.sample_xml_dir,
+    )
+    save_record(record_file.expanduser(), options, outputs, lines_digest)
+    print(f"Created {module_file} and {out_file}")
+    report_changes(outputs)
 
 
 main()